@@ -0,0 +1,28 @@
+import os
+import logging
+import orjson
+
+# Shared by fetch_lims_data.py, transform.py and ingest.py. This module configures no
+# logging of its own, so importing it leaves each script's log setup untouched.
+logger = logging.getLogger('data_store.py')
+
+# --- Legacy data.json Migration ---
+def migrate_legacy_data_file(data_path, legacy_path):
+    """
+    Converts a legacy data.json array into data.jsonl the first time the new store is used.
+    Records are written to a temporary file that replaces data.jsonl only once complete,
+    so an interrupted migration is retried on the next run.
+    """
+    if os.path.exists(data_path) or not os.path.exists(legacy_path):
+        return
+    tmp_path = data_path + '.tmp'
+    try:
+        with open(legacy_path, 'rb') as f:
+            records = orjson.loads(f.read())
+        with open(tmp_path, 'wb') as f:
+            for record in records:
+                f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+        os.replace(tmp_path, data_path)
+        logger.info(f"Migrated {len(records)} records from {legacy_path} to {data_path}.")
+    except (orjson.JSONDecodeError, OSError) as e:
+        logger.error(f"Failed to migrate {legacy_path} to {data_path}: {e}")
@@ -1,14 +1,24 @@
 import os
 import sys
 import re
-import json
 import logging
+import logging.handlers
+import functools
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.etree
+import lxml.html
+import orjson
 from dotenv import load_dotenv
 from pathlib import Path
 import boto3
+from boto3.s3.transfer import TransferConfig
+import botocore.config
+
+from data_store import migrate_legacy_data_file
 
 # --- Base Paths ---
 def get_application_base_dir():
@@ -19,7 +29,6 @@ def get_application_base_dir():
 APPLICATION_BASE_DIR = get_application_base_dir()
 PUBLIC_DIR = Path(APPLICATION_BASE_DIR) / 'public'
 LOGS_DIR = Path(APPLICATION_BASE_DIR) / 'debug'
-DATA_JSON_PATH = PUBLIC_DIR / 'data.json'
 
 os.makedirs(PUBLIC_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
@@ -39,10 +48,27 @@ R2_SECRET_ACCESS_KEY = os.getenv('R2_SECRET_ACCESS_KEY')
 R2_LOG_BUCKET_NAME = os.getenv('R2_LOG_BUCKET_NAME')
 R2_DATA_BUCKET_NAME = os.getenv('R2_DATA_BUCKET_NAME')
 R2_CLIENT_FOLDER = os.getenv('R2_CLIENT_FOLDER')
+# Large uploads are split into 8 MB parts sent in parallel over one client.
+R2_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=8, use_threads=True)
+# One keep-alive pool large enough for the parallel transfer threads, with standard retries.
+R2_CLIENT_CONFIG = botocore.config.Config(max_pool_connections=16, retries={'max_attempts': 3, 'mode': 'standard'})
 
 # File Paths
-DATA_FILE = os.path.join(APPLICATION_BASE_DIR, 'public', 'data.json')
+DATA_FILE = os.path.join(APPLICATION_BASE_DIR, 'public', 'data.jsonl')
+# Pre-JSON Lines store: a single JSON array, converted once by migrate_legacy_data_file()
+LEGACY_DATA_FILE = os.path.join(APPLICATION_BASE_DIR, 'public', 'data.json')
 LAST_RUN_FILE = os.path.join(APPLICATION_BASE_DIR, '.last_run')
+PATIENT_DETAIL_CACHE_FILE = os.path.join(APPLICATION_BASE_DIR, 'public', 'patient_detail_cache.jsonl')
+
+# Concurrent hoverrequest_b.php fetches; the session pool is sized to match.
+DETAIL_FETCH_WORKERS = 16
+HTTP_POOL_SIZE = 32
+# The search date range is split into windows of this many days, fetched concurrently.
+SEARCH_WINDOW_DAYS = 7
+SEARCH_WORKERS = 4
+# Hidden login form token; matched against the raw page bytes so the body is never decoded.
+RDM_TOKEN_RE = re.compile(rb'<input\s+name=["\']rdm["\']\s+type=["\']hidden["\']\s+value=["\']([^"\']+)["\']\s*/?>', re.IGNORECASE)
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
 
 # --- Logging ---
 # Configure console to show INFO level and a file to store all DEBUG level logs
@@ -53,13 +79,35 @@ console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(
 file_handler = logging.FileHandler(LOGS_DIR / 'lims_fetcher_debug.log', mode='w', encoding='utf-8')
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+# Buffer file writes; errors and upload_debug_log() force a flush, and logging.shutdown() flushes at exit.
+log_buffer = logging.handlers.MemoryHandler(capacity=4096, flushLevel=logging.ERROR, target=file_handler)
 
 logging.basicConfig(
     level=logging.DEBUG,  # Set the root logger to DEBUG to capture everything
-    handlers=[console_handler, file_handler]
+    handlers=[console_handler, log_buffer]
 )
 logger = logging.getLogger('fetch_lims_data')
 
+# --- Session ---
+def create_lims_session() -> requests.Session:
+    """
+    Creates a keep-alive Session for the LIMS host. Every request in the run reuses
+    its pooled sockets, sized to serve the concurrent detail fetches.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,  # Only one host (LIMS_URL) is ever contacted.
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Connection': 'keep-alive',
+        'User-Agent': USER_AGENT,
+    })
+    return session
+
 # --- Login ---
 def lims_login(session: requests.Session) -> bool:
     logger.info("Attempting LIMS login...")
@@ -69,15 +117,14 @@ def lims_login(session: requests.Session) -> bool:
     try:
         login_page_url = f"{LIMS_URL}/index.php?m="
         r1 = session.get(login_page_url)
-        logger.debug(f"GET {login_page_url} Status: {r1.status_code}")
+        logger.debug("GET %s Status: %s", login_page_url, r1.status_code)
         
-        pattern = r'<input\s+name=["\']rdm["\']\s+type=["\']hidden["\']\s+value=["\']([^"\']+)["\']\s*/?>'
-        match = re.search(pattern, r1.text, re.IGNORECASE)
+        match = RDM_TOKEN_RE.search(r1.content)
         if not match:
             logger.error("rdm token not found on login page")
             return False
-        rdm_token = match.group(1)
-        logger.debug(f"Found rdm token: {rdm_token}")
+        rdm_token = match.group(1).decode('ascii')
+        logger.debug("Found rdm token: %s", rdm_token)
 
         login_post_url = f"{LIMS_URL}/auth.php"
         payload = {
@@ -88,7 +135,7 @@ def lims_login(session: requests.Session) -> bool:
         }
         headers = {
             "Referer": login_page_url,
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
+            "User-Agent": USER_AGENT,
             "Content-Type": "application/x-www-form-urlencoded",
         }
         r2 = session.post(login_post_url, data=payload, headers=headers, allow_redirects=True)
@@ -105,6 +152,27 @@ def lims_login(session: requests.Session) -> bool:
         logger.exception("Login sequence failed.")
         return False
 
+# --- data.jsonl Store ---
+def iter_data_records():
+    """Yields the records stored in data.jsonl, one per line, skipping unreadable lines."""
+    bad_lines = 0
+    with open(DATA_FILE, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                bad_lines += 1
+    if bad_lines:
+        logger.warning(f"Skipped {bad_lines} unreadable lines in {DATA_FILE}.")
+
+def append_data_records(records):
+    """Appends records to data.jsonl without rewriting what is already stored."""
+    with open(DATA_FILE, 'ab') as f:
+        for rec in records:
+            f.write(orjson.dumps(rec, option=orjson.OPT_APPEND_NEWLINE))
+
 # --- Get Start Date ---
 def get_start_date() -> datetime.date:
     logger.info("Determining start date for data fetch...")
@@ -117,15 +185,16 @@ def get_start_date() -> datetime.date:
             logger.info(f"Found last run timestamp: {last_run_timestamp}. Starting fetch from {last_run_date}.")
             return last_run_date
         except Exception as e:
-            logger.warning(f"Failed reading {LAST_RUN_FILE}: {e}. Falling back to data.json.")
+            logger.warning(f"Failed reading {LAST_RUN_FILE}: {e}. Falling back to data.jsonl.")
 
-    # 2. Fallback to data.json
+    # 2. Fallback to data.jsonl
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                records = json.load(f)
-            if records:
-                latest_date = max(datetime.fromisoformat(r['EncounterDate']).date() for r in records)
+            latest_date = max(
+                (datetime.fromisoformat(r['EncounterDate']).date() for r in iter_data_records()),
+                default=None
+            )
+            if latest_date:
                 logger.info(f"Latest date in existing records: {latest_date}. Fetching new data from {latest_date}.")
                 return latest_date
         except Exception as e:
@@ -137,178 +206,308 @@ def get_start_date() -> datetime.date:
     return default_start
 
 # --- Fetch Patient Details ---
-def fetch_patient_details(session, patient):
+def cell_text(td):
+    """Returns the stripped text of a table cell, reading .text directly when it has no child elements."""
+    if len(td) == 0:
+        return (td.text or '').strip()
+    return ''.join(td.itertext()).strip()
+
+find_details_tables = lxml.etree.XPath(
+    "//table[contains(concat(' ', normalize-space(@class), ' '), ' table-bordered ')]"
+)
+
+def fetch_patient_details(session, patient, cached=None):
     """
     Fetch and parse test details for a given patient from hoverrequest_b.php.
-    Returns a list of dicts with TestCode, TestName.
+    Returns (details, last_modified): a list of dicts with TestName, and the
+    response's Last-Modified header. When a cached entry carries a Last-Modified
+    value the request is made conditional, and a 304 reuses the cached tests.
     Logs warnings for patients with no test table or unexpected HTML.
     """
     url = f"{LIMS_URL}/hoverrequest_b.php?iid={patient['InvoiceNo']}&encounterno={patient['LabNo']}"
     details = []
+    last_modified = None
+    headers = {}
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
     try:
-        r = session.get(url, timeout=30)
+        r = session.get(url, headers=headers, timeout=30)
+        if r.status_code == 304:
+            return [{'TestName': name} for name in cached['tests']], cached['last_modified']
         if r.status_code != 200:
-            logger.warning(f"Failed to fetch details for patient {patient['LabNo']} ({patient['InvoiceNo']}): HTTP {r.status_code}")
-            return details
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-        table = soup.find('table', class_='table-bordered')
-        if not table:
-            logger.warning(f"No details table found for patient {patient['LabNo']} ({patient['InvoiceNo']}) on {patient['EncounterDate']}")
-            return details
-
-        rows = table.find_all('tr')
+            logger.warning("Failed to fetch details for patient %s (%s): HTTP %s", patient['LabNo'], patient['InvoiceNo'], r.status_code)
+            return details, last_modified
+        last_modified = r.headers.get('Last-Modified')
+
+        if not r.content.strip():
+            logger.warning("Empty details response for patient %s (%s) on %s", patient['LabNo'], patient['InvoiceNo'], patient['EncounterDate'])
+            return details, last_modified
+        doc = lxml.html.fromstring(r.content)
+        tables = find_details_tables(doc)
+        if not tables:
+            logger.warning("No details table found for patient %s (%s) on %s", patient['LabNo'], patient['InvoiceNo'], patient['EncounterDate'])
+            return details, last_modified
+
+        rows = tables[0].xpath('.//tr')
         if len(rows) <= 1:
-            logger.warning(f"Details table empty for patient {patient['LabNo']} ({patient['InvoiceNo']}) on {patient['EncounterDate']}")
-            return details
+            logger.warning("Details table empty for patient %s (%s) on %s", patient['LabNo'], patient['InvoiceNo'], patient['EncounterDate'])
+            return details, last_modified
 
         for row in rows[1:]:
-            cells = row.find_all('td')
+            cells = row.xpath('./td')
             if len(cells) < 3:
-                logger.warning(f"Skipping malformed test row for patient {patient['LabNo']} ({patient['InvoiceNo']}) - {len(cells)} cells found")
+                logger.warning("Skipping malformed test row for patient %s (%s) - %d cells found", patient['LabNo'], patient['InvoiceNo'], len(cells))
                 continue
 
-            test_date_raw = cells[0].text.strip()
-            # Try multiple date formats
-            test_date = test_date_raw
-            for fmt in ('%d-%m-%Y', '%Y-%m-%d'):
-                try:
-                    test_date = datetime.strptime(test_date_raw, fmt).strftime('%d-%m-%Y')
-                    break
-                except ValueError:
-                    continue
-
             detail = {
-                'TestName': cells[2].text.strip(),
+                'TestName': cell_text(cells[2]),
             }
             details.append(detail)
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Network error fetching details for {patient['LabNo']} ({patient['InvoiceNo']}): {e}")
+    except lxml.etree.ParserError as e:
+        logger.warning("Unparseable details response for patient %s (%s): %s", patient['LabNo'], patient['InvoiceNo'], e)
     except Exception as e:
         logger.exception(f"Unexpected error fetching details for patient {patient['LabNo']} ({patient['InvoiceNo']})")
 
     if not details:
-        logger.info(f"No tests found for patient {patient['LabNo']} ({patient['InvoiceNo']}) on {patient['EncounterDate']}")
+        logger.info("No tests found for patient %s (%s) on %s", patient['LabNo'], patient['InvoiceNo'], patient['EncounterDate'])
+
+    return details, last_modified
+
+# --- Patient Detail Cache ---
+def detail_cache_key(patient):
+    """Returns the patient_detail_cache.jsonl key for a patient visit."""
+    return f"{patient['LabNo']}|{patient['InvoiceNo']}"
+
+def load_patient_detail_cache():
+    """Loads cached test names per patient visit; later lines override earlier ones."""
+    cache = {}
+    if not os.path.exists(PATIENT_DETAIL_CACHE_FILE):
+        return cache
+    with open(PATIENT_DETAIL_CACHE_FILE, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = orjson.loads(line)
+                cache[entry['key']] = entry
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                continue
+    logger.info(f"Loaded {len(cache)} cached patient details from {PATIENT_DETAIL_CACHE_FILE}.")
+    return cache
+
+def append_patient_detail_cache(entries):
+    """Appends new or changed cache entries to patient_detail_cache.jsonl."""
+    if not entries:
+        return
+    with open(PATIENT_DETAIL_CACHE_FILE, 'ab') as f:
+        for entry in entries:
+            f.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+    logger.info(f"Cached details for {len(entries)} patients in {PATIENT_DETAIL_CACHE_FILE}.")
 
-    return details
+def get_patient_details(session, patient, detail_cache, today):
+    """
+    Returns (details, cache_entry) for a patient. A cached entry is served without
+    a request only if it was fetched after the encounter date, since tests can still
+    be added on the day of the visit; otherwise the details are refetched conditionally.
+    cache_entry is the entry to store, which is the cached one when nothing changed.
+    """
+    cached = detail_cache.get(detail_cache_key(patient))
+    if cached and cached.get('fetched_on', '') > patient['EncounterDate']:
+        return [{'TestName': name} for name in cached['tests']], cached
+
+    details, last_modified = fetch_patient_details(session, patient, cached)
+    if not details:
+        # Empty results may be transient, so they are never cached.
+        return details, cached
+    tests = [detail['TestName'] for detail in details]
+    if (cached and cached['tests'] == tests and cached.get('last_modified') == last_modified
+            and cached.get('fetched_on') == today):
+        return details, cached
+    return details, {'key': detail_cache_key(patient), 'tests': tests, 'last_modified': last_modified, 'fetched_on': today}
 
 # --- Fetch Data ---
-def fetch_lims_data(session, start_date):
+def iter_search_result_rows(response):
     """
-    Fetch LIMS patient data by date range, then fetch test details for each unique patient.
-    Returns a flat list of test records.
+    Stream-parses the search results page as it downloads, yielding the stripped
+    cell texts of each data row in the patient table (id="list").
+    Finished rows are discarded, so memory stays proportional to one row.
     """
-    end_date = datetime.now().date()
-    all_patients_info = {} # Stores unique patients as {patient_key: patient_data}
-    
-    logger.info(f"Fetching LIMS data from {start_date.isoformat()} to {end_date.isoformat()}...")
+    parser = lxml.etree.HTMLPullParser(events=('end',), tag='tr', encoding='utf-8')
+    header_skipped = False
+
+    def finished_rows():
+        nonlocal header_skipped
+        for _, row in parser.read_events():
+            table = next(row.iterancestors('table'), None)
+            if table is None or table.get('id') != 'list':
+                continue
+            cells = [cell_text(td) for td in row.iterchildren('td')]
+            row.clear(keep_tail=True)
+            while row.getprevious() is not None:
+                del row.getparent()[0]
+            if not header_skipped:
+                header_skipped = True
+                continue
+            yield cells
 
+    for chunk in response.iter_content(chunk_size=65536):
+        parser.feed(chunk)
+        yield from finished_rows()
+    parser.close()
+    yield from finished_rows()
+
+def search_patients(session, window_start, window_end):
+    """
+    Runs the LIMS date-range search for one window and returns (row_count, patients),
+    where patients is the list of well-formed patient rows in page order.
+    Network errors are raised to the caller.
+    """
     search_params = {
         'searchtype': 'daterange',
-        'daterange': f"{start_date.strftime('%m/%d/%Y')} - {end_date.strftime('%m/%d/%Y')}",
+        'daterange': f"{window_start.strftime('%m/%d/%Y')} - {window_end.strftime('%m/%d/%Y')}",
         'Get': 'Get'
     }
-
-    try:
-        r = session.get(SEARCH_URL, params=search_params, timeout=300)
+    # The streamed response is closed on every exit so its connection returns to the pool.
+    with session.get(SEARCH_URL, params=search_params, stream=True, timeout=300) as r:
         r.raise_for_status()
-        
-        soup = BeautifulSoup(r.text, 'html.parser')
-        table = soup.find('table', id='list')
 
-        if not table:
-            logger.warning("No patient table found on search results page.")
-            return []
-
-        rows = table.find_all('tr')[1:]  # Skip header row
-        logger.info(f"Found {len(rows)} patients in total.")
-
-        for row in rows:
-            cells = row.find_all('td')
+        row_count = 0
+        patients = []
+        for cells in iter_search_result_rows(r):
+            row_count += 1
             if len(cells) < 8:
-                logger.warning(f"Skipping malformed patient row with {len(cells)} cells.")
+                logger.warning("Skipping malformed patient row with %d cells.", len(cells))
                 continue
-            
+        
             try:
-                encounter_date = datetime.strptime(cells[0].text.strip(), '%d-%m-%Y').date().isoformat()
+                encounter_date = datetime.strptime(cells[0], '%d-%m-%Y').date().isoformat()
             except ValueError:
-                logger.warning(f"Skipping patient with bad date format: {cells[0].text.strip()}")
+                logger.warning("Skipping patient with bad date format: %s", cells[0])
                 continue
-            
-            patient = {
+        
+            patients.append({
                 "EncounterDate": encounter_date,
-                "LabNo": cells[1].text.strip(),
-                "InvoiceNo": cells[3].text.strip(),
-                "PNo": cells[4].text.strip(),
-                "Patient": cells[5].text.strip(),
-                "Tel": cells[6].text.strip(),
-                "Src": cells[7].text.strip()
-            }
-            
-            patient_key = patient['LabNo']
-            if patient_key not in all_patients_info:
-                all_patients_info[patient_key] = patient
+                "LabNo": cells[1],
+                "InvoiceNo": cells[3],
+                "PNo": cells[4],
+                "Patient": cells[5],
+                "Tel": cells[6],
+                "Src": cells[7]
+            })
+        return row_count, patients
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error during initial patient search: {e}")
+def fetch_lims_data(session, start_date):
+    """
+    Fetch LIMS patient data by date range, then fetch test details for each unique patient.
+    Returns a flat list of test records.
+    """
+    end_date = datetime.now().date()
+    patients = [] # Unique patients in first-seen order
+    seen_labnos = set()
+    
+    logger.info(f"Fetching LIMS data from {start_date.isoformat()} to {end_date.isoformat()}...")
+
+    # Search in fixed-size windows so each page is smaller and the server scans them in parallel.
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + timedelta(days=SEARCH_WINDOW_DAYS - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+
+    row_count = 0
+    failed_windows = 0
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+        futures = [executor.submit(search_patients, session, ws, we) for ws, we in windows]
+        # Merge in window order so the first occurrence of a patient wins, as with a single search.
+        for (ws, we), future in zip(windows, futures):
+            try:
+                window_rows, window_patients = future.result()
+            except requests.exceptions.RequestException as e:
+                failed_windows += 1
+                logger.error(f"Network error during patient search for {ws.isoformat()} to {we.isoformat()}: {e}")
+                continue
+            except Exception:
+                failed_windows += 1
+                logger.exception(f"Unexpected error during patient search for {ws.isoformat()} to {we.isoformat()}.")
+                continue
+
+            row_count += window_rows
+            for patient in window_patients:
+                if patient['LabNo'] in seen_labnos:
+                    continue
+                seen_labnos.add(patient['LabNo'])
+                patients.append(patient)
+
+    if failed_windows == len(windows):
         return []
-    except Exception as e:
-        logger.exception("Unexpected error during patient search.")
+    if not row_count:
+        logger.warning("No patient rows found on search results page.")
         return []
+    logger.info(f"Found {row_count} patients in total across {len(windows) - failed_windows} of {len(windows)} search windows.")
 
-    logger.info(f"Processing details for {len(all_patients_info)} unique patients.")
+    logger.info(f"Processing details for {len(patients)} unique patients.")
     final_records = []
+    detail_cache = load_patient_detail_cache()
+    changed_cache_entries = []
+    today = end_date.isoformat()
     
-    for idx, patient_data in enumerate(all_patients_info.values(), 1):
-        if idx % 100 == 0:
-            logger.info(f"Processing details for patient {idx} of {len(all_patients_info)}...")
+    # Details are fetched concurrently; map() keeps results in patient order.
+    with ThreadPoolExecutor(max_workers=DETAIL_FETCH_WORKERS) as executor:
+        results = executor.map(lambda p: get_patient_details(session, p, detail_cache, today), patients)
+        for idx, (patient_data, (test_details, cache_entry)) in enumerate(zip(patients, results), 1):
+            if idx % 100 == 0:
+                logger.info(f"Processing details for patient {idx} of {len(patients)}...")
             
-        test_details = fetch_patient_details(session, patient_data)
-        
-        for test in test_details:
-            record = patient_data.copy()
-            record.update(test)
-            final_records.append(record)
+            if cache_entry is not None and cache_entry is not detail_cache.get(cache_entry['key']):
+                changed_cache_entries.append(cache_entry)
+            
+            for test in test_details:
+                record = patient_data.copy()
+                record.update(test)
+                final_records.append(record)
+
+    append_patient_detail_cache(changed_cache_entries)
 
     logger.info(f"Fetched a total of {len(final_records)} test records.")
     return final_records
 
 # --- Save + Upload ---
+def record_key(record):
+    """Returns the identity of a data.jsonl test record used for de-duplication."""
+    return (record.get('LabNo'), record.get('InvoiceNo'), record.get('TestName', ''))
+
 def save_and_upload(new_records):
-    """Saves new records by appending to data.json and uploads debug logs to R2."""
+    """Saves new records by appending to data.jsonl and uploads debug logs to R2."""
     if not new_records:
         logger.info("No new records to save or upload.")
-        upload_to_r2(os.path.join(LOGS_DIR, 'lims_fetcher_debug.log'), R2_LOG_BUCKET_NAME)
+        upload_debug_log()
         return
 
-    existing_data = []
+    # A test record is identified by its patient visit, invoice and test name.
+    existing_keys = set()
     if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r') as f:
-                existing_data = json.load(f)
-            logger.info(f"Loaded {len(existing_data)} existing records from {DATA_FILE}.")
-        except (json.JSONDecodeError, FileNotFoundError):
-            logger.warning(f"Existing {DATA_FILE} is empty or corrupted. Starting fresh.")
+        existing_keys = {record_key(rec) for rec in iter_data_records()}
+        logger.info(f"Loaded {len(existing_keys)} existing record keys from {DATA_FILE}.")
 
-    # Convert records to a hashable format (tuple of sorted items) for a set
-    existing_set = {tuple(sorted(rec.items())) for rec in existing_data}
-    new_set = {tuple(sorted(rec.items())) for rec in new_records}
-
-    # Find truly new records
-    truly_new_records_set = new_set - existing_set
-    truly_new_records = [dict(t) for t in truly_new_records_set]
+    truly_new_records = []
+    for rec in new_records:
+        key = record_key(rec)
+        if key not in existing_keys:
+            existing_keys.add(key)
+            truly_new_records.append(rec)
 
     if truly_new_records:
-        final_data = existing_data + truly_new_records
-        with open(DATA_FILE, 'w') as f:
-            json.dump(final_data, f, indent=4)
-        logger.info(f"Saved {len(truly_new_records)} truly new records. Total records now: {len(final_data)}.")
+        append_data_records(truly_new_records)
+        logger.info(f"Saved {len(truly_new_records)} truly new records. Total records now: {len(existing_keys)}.")
     else:
         logger.info("No new unique records found to append.")
     
     # Upload the debug log to R2
-    upload_to_r2(os.path.join(LOGS_DIR, 'lims_fetcher_debug.log'), R2_LOG_BUCKET_NAME)
+    upload_debug_log()
 
 def get_last_run_timestamp():
     """Retrieves the timestamp of the last successful run."""
@@ -333,6 +532,15 @@ def save_last_run_timestamp(timestamp):
     except Exception as e:
         logger.error(f"Failed to save last run timestamp: {e}")
 
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    """Returns the R2 client, created once and reused for every upload."""
+    return boto3.client('s3',
+                        endpoint_url=R2_ENDPOINT_URL,
+                        aws_access_key_id=R2_ACCESS_KEY_ID,
+                        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                        config=R2_CLIENT_CONFIG)
+
 def upload_to_r2(file_path, bucket):
     """Uploads a file to a specific R2 bucket and client folder."""
     logger.info(f"Attempting to upload {os.path.basename(file_path)} to R2 bucket {bucket}...")
@@ -340,24 +548,25 @@ def upload_to_r2(file_path, bucket):
         logger.error("R2 credentials or client folder incomplete. Skipping upload.")
         return
     try:
-        s3 = boto3.client('s3',
-                          endpoint_url=R2_ENDPOINT_URL,
-                          aws_access_key_id=R2_ACCESS_KEY_ID,
-                          aws_secret_access_key=R2_SECRET_ACCESS_KEY)
-
         object_key = f"{R2_CLIENT_FOLDER}/{os.path.basename(file_path)}"
         
-        s3.upload_file(file_path, bucket, object_key)
+        get_s3_client().upload_file(file_path, bucket, object_key, Config=R2_TRANSFER_CONFIG)
         logger.info(f"Uploaded {os.path.basename(file_path)} to R2 at key: {object_key}.")
     except Exception as e:
         logger.exception(f"Failed to upload {os.path.basename(file_path)} to R2: {e}")
 
+def upload_debug_log():
+    """Flushes buffered log records to the debug log file and uploads it to R2."""
+    log_buffer.flush()
+    upload_to_r2(os.path.join(LOGS_DIR, 'lims_fetcher_debug.log'), R2_LOG_BUCKET_NAME)
+
 # --- Main ---
 def run():
     """Main execution function for the LIMS data fetcher."""
     logger.info("Starting LIMS data fetch...")
+    migrate_legacy_data_file(DATA_FILE, LEGACY_DATA_FILE)
     
-    s = requests.Session()
+    s = create_lims_session()
     
     if not lims_login(s):
         logger.error("Failed to login to LIMS. Exiting.")
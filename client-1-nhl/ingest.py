@@ -1,22 +1,30 @@
 import os
 import sys
-import json
+import io
 import logging
-from datetime import datetime, timedelta
+import logging.handlers
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import psycopg2
 import psycopg2.extras
 from psycopg2 import sql
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 import boto3
+from boto3.s3.transfer import TransferConfig
+import botocore.config
 import csv
-from typing import List, Dict, Any
-import ijson
+from collections import defaultdict
+import pickle
+import orjson
 import re
+import pandas as pd
 
 # Assuming `transform.py` exists in the same directory or is importable
 # It defines calculate_delay_status_and_range
 from transform import DEFAULT_DATETIME_DT, DEFAULT_DATETIME_STR, calculate_delay_status_and_range
+from data_store import migrate_legacy_data_file
 
 # --- Environment and Path Configuration ---
 def get_application_base_dir():
@@ -33,24 +41,31 @@ load_dotenv(os.path.join(APPLICATION_BASE_DIR, '.env'))
 # --- File Locations ---
 LOCAL_PUBLIC_DIR = os.path.join(APPLICATION_BASE_DIR, 'public')
 LOGS_DIR = os.path.join(APPLICATION_BASE_DIR, 'debug')
-TESTS_DATASET_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'tests_dataset.json')
-PATIENTS_DATASET_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'patients_dataset.json')
+TESTS_DATASET_JSONL_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'tests_dataset.jsonl')
+PATIENTS_DATASET_JSONL_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'patients_dataset.jsonl')
 TIMEOUT_CSV_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'TimeOut.csv')
-DATA_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'data.json')
+DATA_JSONL_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'data.jsonl')
+LEGACY_DATA_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'data.json')
+LABNO_TO_INVOICES_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'labno_to_invoices.pkl')
 
 # Ensure logs directory exists
 os.makedirs(LOGS_DIR, exist_ok=True)
 
 # --- Logging Setup ---
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+log_file_handler = logging.FileHandler(os.path.join(LOGS_DIR, 'ingest_debug.log'))
+log_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+# The log file is written in blocks; errors and upload_logs_to_r2() force a flush.
+log_buffer = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=log_file_handler)
+# basicConfig is a no-op once transform.py has configured the root logger, so the
+# buffered file handler is attached to this module's logger directly.
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(os.path.join(LOGS_DIR, 'ingest_debug.log'))
-    ]
+    format=LOG_FORMAT,
+    handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger('ingest.py')
+logger.addHandler(log_buffer)
 
 
 # --- Database Schema Definitions ---
@@ -85,67 +100,189 @@ CREATE TABLE IF NOT EXISTS tests (
 );
 """
 
+# Partial index over the rows update_incomplete_records looks for.
+PATIENTS_INCOMPLETE_INDEX = """
+CREATE INDEX IF NOT EXISTS ix_patients_incomplete ON patients (lab_number)
+WHERE request_time_out IS NULL OR request_time_out = '1970-01-01 00:00:00'::timestamp;
+"""
+
 # --- Helper Functions ---
+# Placeholder strings that stand for "no timestamp" in the generated datasets.
+NULL_DATETIME_STRINGS = frozenset(['N/A', DEFAULT_DATETIME_STR])
+# Compiled fast paths for the strptime formats below; each regex matches a subset of its format.
+# Canonical dataset timestamp written by transform.py: '%Y-%m-%d %H:%M:%S'.
+_ISO_DATETIME_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2}) (\d{1,2}):(\d{1,2}):(\d{1,2})')
+# 24-hour fallback accepted by parse_datetime_field: '%m/%d/%Y %H:%M'.
+_US_DATETIME_RE = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{1,2})')
+# 12-hour TimeOut.csv CreationTime written by timeout.py: '%m/%d/%Y %I:%M %p'.
+_TIMEOUT_DATETIME_RE = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{1,2}) ([AP]M)', re.IGNORECASE)
+DATETIME_FIELD_FORMATS = ('%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M')
+CREATION_TIME_FORMAT = '%m/%d/%Y %I:%M %p'
+# Number of offending values quoted in each aggregated parse warning.
+LOG_SAMPLE_SIZE = 5
+
 def parse_datetime_field(dt_str: str | None) -> datetime | None:
     """
     Parses a datetime string and returns a naive datetime object (no timezone).
     Returns None if string is a known invalid/default timestamp (e.g., Unix epoch).
     """
-    if not dt_str:
+    if not dt_str or dt_str in NULL_DATETIME_STRINGS:
         return None
-
-    if dt_str in ['N/A', DEFAULT_DATETIME_STR]:
+    return _parse_datetime_cached(dt_str)
+
+@functools.lru_cache(maxsize=65536)
+def _parse_datetime_cached(dt_str: str) -> datetime | None:
+    """Memoized worker for parse_datetime_field; timestamps repeat heavily across rows."""
+    naive_dt = _parse_field_datetime(dt_str)
+    if naive_dt is None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Unable to parse datetime string '{dt_str}': no matching date format")
+        return None
+    if naive_dt == DEFAULT_DATETIME_DT:
         return None
+    return naive_dt
 
+def _parse_field_datetime(dt_str: str) -> datetime | None:
+    """Parses one of DATETIME_FIELD_FORMATS, trying the compiled regexes before strptime."""
     try:
-        naive_dt = datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S')
-        if naive_dt == datetime(1970, 1, 1, 0, 0):
-            return None
-        return naive_dt
-
+        match = _ISO_DATETIME_RE.fullmatch(dt_str)
+        if match:
+            return datetime(*map(int, match.groups()))
+        match = _US_DATETIME_RE.fullmatch(dt_str)
+        if match:
+            month, day, year, hour, minute = map(int, match.groups())
+            return datetime(year, month, day, hour, minute)
     except ValueError:
+        return None
+
+    for fmt in DATETIME_FIELD_FORMATS:
         try:
-            naive_dt = datetime.strptime(dt_str, '%m/%d/%Y %H:%M')
-            if naive_dt == datetime(1970, 1, 1, 0, 0):
-                return None
-            return naive_dt
-        except Exception as inner_e:
-            logger.warning(f"Unable to parse datetime string '{dt_str}': {inner_e}")
+            return datetime.strptime(dt_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+def parse_datetime_column(values: pd.Series) -> pd.Series:
+    """
+    Vectorized parse_datetime_field over a column of dataset strings.
+    Returns an object Series holding timestamps, with None for missing/default values.
+    """
+    parsed = pd.to_datetime(values, format='%Y-%m-%d %H:%M:%S', errors='coerce', cache=True)
+    parsed = parsed.mask(parsed == DEFAULT_DATETIME_DT)
+    result = parsed.astype(object).where(parsed.notna(), None)
+
+    # Values the fixed format could not handle go through the scalar parser.
+    fallback = parsed.isna() & values.notna() & ~values.isin(NULL_DATETIME_STRINGS)
+    if fallback.any():
+        result[fallback] = values[fallback].map(parse_datetime_field)
+        unparsed = values[fallback][result[fallback].isna()]
+        if len(unparsed):
+            sample = ', '.join(repr(value) for value in unparsed.unique()[:LOG_SAMPLE_SIZE])
+            logger.warning(f"Loaded {len(unparsed)} unrecognised '{values.name}' values as NULL, e.g. {sample}.")
+    return result
+
+def build_rows(records, fields, datetime_fields):
+    """Converts dataset records into row tuples ordered as fields, parsing datetime_fields column-wise."""
+    df = pd.DataFrame.from_records(records, columns=fields)
+    for field in datetime_fields:
+        df[field] = parse_datetime_column(df[field])
+    # Missing values come back from pandas as NaN; turn them back into None so they load as NULL.
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+def _parse_creation_time(creation_time_str):
+    """Parses a TimeOut.csv CreationTime in CREATION_TIME_FORMAT, returning None if it does not match."""
+    match = _TIMEOUT_DATETIME_RE.fullmatch(creation_time_str)
+    if match:
+        month, day, year, hour, minute = map(int, match.groups()[:5])
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if match.group(6).upper() == 'PM' else 0)
+        try:
+            return datetime(year, month, day, hour, minute)
+        except ValueError:
             return None
+    try:
+        return datetime.strptime(creation_time_str, CREATION_TIME_FORMAT)
+    except ValueError:
+        return None
 
 def load_timeout_data():
     """Loads TimeOut.csv into a dictionary for efficient lookup."""
     timeout_data = {}
-    date_formats = ['%m/%d/%Y %I:%M %p', '%#m/%#d/%Y %I:%M %p']
+    unparsed_rows = 0
+    unparsed_samples = []
+    # Many invoices share a CreationTime minute; parse each distinct string once.
+    parsed_times = {}
     try:
         with open(TIMEOUT_CSV_PATH, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if not header:
+                return timeout_data
+            fn_idx = header.index('FileName')
+            ct_idx = header.index('CreationTime')
+            min_len = max(fn_idx, ct_idx) + 1
             for row in reader:
-                invoice_no = row.get('FileName')
-                creation_time_str = row.get('CreationTime')
+                if len(row) < min_len:
+                    continue
+                invoice_no = row[fn_idx]
+                creation_time_str = row[ct_idx]
                 if not invoice_no or not creation_time_str:
                     continue
                 
-                creation_time_dt = None
-                for fmt in date_formats:
-                    try:
-                        creation_time_dt = datetime.strptime(creation_time_str, fmt)
-                        break
-                    except ValueError:
-                        continue
+                if creation_time_str in parsed_times:
+                    creation_time_dt = parsed_times[creation_time_str]
+                else:
+                    creation_time_dt = _parse_creation_time(creation_time_str)
+                    parsed_times[creation_time_str] = creation_time_dt
                 
                 if creation_time_dt:
                     if invoice_no not in timeout_data or creation_time_dt > timeout_data[invoice_no]['CreationTime']:
                         timeout_data[invoice_no] = {'CreationTime': creation_time_dt}
                 else:
-                    logger.warning(f"Failed to parse CreationTime '{creation_time_str}' for invoice '{invoice_no}'. No matching date format found.")
+                    unparsed_rows += 1
+                    if len(unparsed_samples) < LOG_SAMPLE_SIZE:
+                        unparsed_samples.append(f"{invoice_no}: {creation_time_str!r}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Failed to parse CreationTime '{creation_time_str}' for invoice '{invoice_no}'. No matching date format found.")
 
     except Exception as e:
         logger.error(f"Failed to load TimeOut.csv for post-ingestion updates: {e}")
+    if unparsed_rows:
+        logger.warning(f"Skipped {unparsed_rows} TimeOut.csv rows with an unrecognised CreationTime format, "
+                       f"e.g. {', '.join(unparsed_samples)}.")
     return timeout_data
 
+# Multipart settings for log uploads; small logs go up in a single PUT.
+R2_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4, use_threads=True)
+R2_CLIENT_CONFIG = botocore.config.Config(max_pool_connections=16, retries={'max_attempts': 3, 'mode': 'standard'})
+
+@functools.lru_cache(maxsize=1)
+def _get_s3_client(endpoint_url, access_key_id, secret_access_key):
+    """Returns a cached S3 client for the given credentials. boto3 clients are thread-safe."""
+    session = boto3.session.Session()
+    return session.client(
+        's3',
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        config=R2_CLIENT_CONFIG
+    )
+
+def _upload_log_file(s3_client, file_path, bucket_name, client_folder):
+    """Uploads a single log file under the client folder prefix, logging the outcome."""
+    try:
+        # Construct the object key with the client folder prefix
+        object_key = f"{client_folder}/{os.path.basename(file_path)}"
+        s3_client.upload_file(file_path, bucket_name, object_key, Config=R2_TRANSFER_CONFIG)
+        logger.info(f"Successfully uploaded {os.path.basename(file_path)} to R2 bucket '{bucket_name}' at key '{object_key}'.")
+    except Exception as e:
+        logger.error(f"Failed to upload {os.path.basename(file_path)} to R2: {e}")
+
 def upload_logs_to_r2():
     """Uploads specified log files to Cloudflare R2 or S3-compatible storage."""
+    log_buffer.flush()
     r2_endpoint_url = os.getenv('R2_ENDPOINT_URL')
     r2_access_key_id = os.getenv('R2_ACCESS_KEY_ID')
     r2_secret_access_key = os.getenv('R2_SECRET_ACCESS_KEY')
@@ -156,13 +293,7 @@ def upload_logs_to_r2():
         logger.error("R2 credentials not fully configured, including R2_CLIENT_FOLDER. Skipping log upload.")
         return
 
-    session = boto3.session.Session()
-    s3_client = session.client(
-        's3',
-        endpoint_url=r2_endpoint_url,
-        aws_access_key_id=r2_access_key_id,
-        aws_secret_access_key=r2_secret_access_key
-    )
+    s3_client = _get_s3_client(r2_endpoint_url, r2_access_key_id, r2_secret_access_key)
 
     log_files_to_upload = [
         os.path.join(LOGS_DIR, 'ingest_debug.log'),
@@ -171,67 +302,168 @@ def upload_logs_to_r2():
         os.path.join(LOGS_DIR, 'tests_dataset_debug.log')
     ]
 
+    existing_files = []
     for file_path in log_files_to_upload:
         if os.path.exists(file_path):
-            try:
-                # Construct the object key with the client folder prefix
-                object_key = f"{r2_client_folder}/{os.path.basename(file_path)}"
-                s3_client.upload_file(file_path, r2_log_bucket_name, object_key)
-                logger.info(f"Successfully uploaded {os.path.basename(file_path)} to R2 bucket '{r2_log_bucket_name}' at key '{object_key}'.")
-            except Exception as e:
-                logger.error(f"Failed to upload {os.path.basename(file_path)} to R2: {e}")
+            existing_files.append(file_path)
         else:
             logger.warning(f"Log file not found, skipping upload: {file_path}")
 
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for file_path in existing_files:
+            executor.submit(_upload_log_file, s3_client, file_path, r2_log_bucket_name, r2_client_folder)
+
 # --- Core Ingestion Logic ---
-def ingest_data(cursor, table_name, data_list, primary_key, columns, BATCH_SIZE=1000):
+# Below this many rows the COPY/staging-table setup costs more than it saves.
+COPY_THRESHOLD = 1024
+# Number of dataset records parsed and loaded per ingest_data call.
+INGEST_BATCH_SIZE = 10000
+
+def _copy_text_value(value):
+    """Formats a single value for PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+def _build_copy_buffer(data_list):
+    """Serializes row tuples into an in-memory tab-separated COPY buffer."""
+    buf = io.StringIO()
+    for row in data_list:
+        buf.write('\t'.join(_copy_text_value(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+@functools.lru_cache(maxsize=32)
+def _build_upsert(table_name, columns, primary_key, update_on_conflict):
     """
-    Ingests data into a table in batches, handling idempotency.
+    Composes the statements ingest_data needs for one table layout.
+    Returns (create_staging, copy_staging, insert_from_staging, drop_staging, insert_values).
     """
-    if not data_list:
-        logger.info(f"No new records to ingest for table '{table_name}'.")
-        return
-    
-    placeholders = sql.SQL(', ').join(sql.Placeholder() * len(columns))
+    table = sql.Identifier(table_name)
+    staging_table = sql.Identifier(f"staging_{table_name}")
     insert_columns = sql.SQL(', ').join(sql.Identifier(col) for col in columns)
-    update_set_clause = sql.SQL(', ').join(
-        sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col))
-        for col in columns if col != primary_key
-    )
+    if update_on_conflict:
+        conflict_action = sql.SQL("DO UPDATE SET {}").format(sql.SQL(', ').join(
+            sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col))
+            for col in columns if col != primary_key
+        ))
+    else:
+        conflict_action = sql.SQL("DO NOTHING")
 
-    insert_query = sql.SQL("""
-        INSERT INTO {} ({}) VALUES ({})
-        ON CONFLICT ({}) DO UPDATE SET {}
+    create_staging = sql.SQL(
+        "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP"
+    ).format(staging_table, table)
+    copy_staging = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT text)").format(
+        staging_table, insert_columns
+    )
+    insert_from_staging = sql.SQL("""
+        INSERT INTO {} ({}) SELECT {} FROM {}
+        ON CONFLICT ({}) {}
     """).format(
-        sql.Identifier(table_name),
+        table,
+        insert_columns,
         insert_columns,
-        placeholders,
+        staging_table,
         sql.Identifier(primary_key),
-        update_set_clause
+        conflict_action
     )
+    drop_staging = sql.SQL("DROP TABLE {}").format(staging_table)
+    insert_values = sql.SQL("""
+        INSERT INTO {} ({}) VALUES %s
+        ON CONFLICT ({}) {}
+    """).format(
+        table,
+        insert_columns,
+        sql.Identifier(primary_key),
+        conflict_action
+    )
+    return create_staging, copy_staging, insert_from_staging, drop_staging, insert_values
+
+def ingest_data(cursor, table_name, data_list, primary_key, columns, BATCH_SIZE=1000, update_on_conflict=True):
+    """
+    Ingests data into a table in batches, handling idempotency.
+    Large loads are streamed through COPY into a staging table and upserted
+    from there; small ones use a multi-row VALUES insert.
+    With update_on_conflict=False, rows whose key already exists are left untouched.
+    """
+    if not data_list:
+        logger.info(f"No new records to ingest for table '{table_name}'.")
+        return
     
+    create_staging, copy_staging, insert_from_staging, drop_staging, insert_values = _build_upsert(
+        table_name, tuple(columns), primary_key, update_on_conflict
+    )
+
     try:
-        execute_batch(cursor, insert_query, data_list, page_size=BATCH_SIZE)
+        if len(data_list) > COPY_THRESHOLD:
+            cursor.execute(create_staging)
+            cursor.copy_expert(copy_staging.as_string(cursor), _build_copy_buffer(data_list))
+            cursor.execute(insert_from_staging)
+            cursor.execute(drop_staging)
+        else:
+            execute_values(cursor, insert_values.as_string(cursor), data_list, page_size=BATCH_SIZE)
         logger.info(f"Successfully ingested {len(data_list)} records into '{table_name}'.")
     except Exception as e:
         logger.error(f"Failed to ingest data into '{table_name}': {e}")
         raise
 
+def iter_jsonl_batches(path, batch_size=INGEST_BATCH_SIZE):
+    """Yields lists of records from a JSON Lines file, at most batch_size records at a time."""
+    batch = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(orjson.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
 def ensure_tables_exist(cursor):
     """Creates tables if they don't already exist."""
     logger.info("Ensuring database tables exist...")
     cursor.execute(PATIENTS_SCHEMA)
     cursor.execute(TESTS_SCHEMA)
+    cursor.execute(PATIENTS_INCOMPLETE_INDEX)
     logger.info("Tables 'patients' and 'tests' are ready.")
 
-def get_existing_ids(cursor, table_name, primary_key):
-    """Queries the database to get a set of existing primary keys."""
+def load_labno_to_invoices():
+    """
+    Loads the LabNo -> InvoiceNos mapping written by transform.py.
+    Falls back to building it from data.jsonl if the sidecar is missing or unreadable.
+    Returns None if neither source is available.
+    """
     try:
-        cursor.execute(sql.SQL("SELECT {} FROM {}").format(sql.Identifier(primary_key), sql.Identifier(table_name)))
-        return {row[0] for row in cursor.fetchall()}
-    except psycopg2.Error as e:
-        logger.error(f"Error querying existing IDs from '{table_name}': {e}. Proceeding with empty set.")
-        return set()
+        with open(LABNO_TO_INVOICES_PATH, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        logger.warning(f"{LABNO_TO_INVOICES_PATH} not found. Rebuilding invoice mapping from data.jsonl.")
+    except (pickle.UnpicklingError, EOFError) as e:
+        logger.warning(f"Failed to load {LABNO_TO_INVOICES_PATH}: {e}. Rebuilding invoice mapping from data.jsonl.")
+
+    migrate_legacy_data_file(DATA_JSONL_PATH, LEGACY_DATA_JSON_PATH)
+    labno_to_invoices = defaultdict(list)
+    try:
+        with open(DATA_JSONL_PATH, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                labno = record.get('LabNo')
+                invoiceno = record.get('InvoiceNo')
+                if labno and invoiceno:
+                    labno_to_invoices[labno].append(invoiceno)
+    except FileNotFoundError:
+        logger.error("data.jsonl not found, cannot update incomplete records.")
+        return None
+    return dict(labno_to_invoices)
 
 def update_incomplete_records(conn, cursor, timeout_data):
     """
@@ -240,85 +472,104 @@ def update_incomplete_records(conn, cursor, timeout_data):
     """
     logger.info("Starting post-ingestion update for incomplete records...")
     
-    # Query for records with the default placeholder or NULL
-    query_incomplete = sql.SQL("""
-        SELECT lab_number, time_in, request_time_expected
-        FROM patients
-        WHERE request_time_out = %s OR request_time_out IS NULL;
-    """)
-    
-    cursor.execute(query_incomplete, (DEFAULT_DATETIME_DT,))
-    incomplete_records = cursor.fetchall()
-    
-    if not incomplete_records:
+    # Records with the default placeholder or NULL; matches ix_patients_incomplete.
+    incomplete_condition = sql.SQL(
+        "(p.request_time_out IS NULL OR p.request_time_out = '1970-01-01 00:00:00'::timestamp)"
+    )
+
+    cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM patients p WHERE {})").format(incomplete_condition))
+    if not cursor.fetchone()[0]:
         logger.info("No incomplete 'patients' records found to update.")
         return
     
-    # Re-parse data.json to create a mapping from lab_number to all associated invoice numbers
-    labno_to_invoices = {}
+    labno_to_invoices = load_labno_to_invoices()
+    if labno_to_invoices is None:
+        return
+
+    # A savepoint scopes failures in this step, so the caller's ingested tests and patients survive them.
+    cursor.execute("SAVEPOINT update_incomplete")
     try:
-        with open(DATA_JSON_PATH, 'rb') as f:
-            parser = ijson.items(f, 'item')
-            for record in parser:
-                labno = record.get('LabNo')
-                invoiceno = record.get('InvoiceNo')
-                if labno and invoiceno:
-                    if labno not in labno_to_invoices:
-                        labno_to_invoices[labno] = set()
-                    labno_to_invoices[labno].add(invoiceno)
-    except FileNotFoundError:
-        logger.error("data.json not found, cannot update incomplete records.")
+        # Let PostgreSQL match incomplete patients to their latest TimeOut entry.
+        cursor.execute("""
+            CREATE TEMP TABLE incomplete_timeouts (invoice_no TEXT, creation_time TIMESTAMP) ON COMMIT DROP;
+            CREATE TEMP TABLE incomplete_invoices (lab_number TEXT, invoice_no TEXT) ON COMMIT DROP;
+        """)
+        cursor.copy_expert(
+            "COPY incomplete_timeouts (invoice_no, creation_time) FROM STDIN WITH (FORMAT text)",
+            _build_copy_buffer((invoice_no, info['CreationTime']) for invoice_no, info in timeout_data.items())
+        )
+        cursor.copy_expert(
+            "COPY incomplete_invoices (lab_number, invoice_no) FROM STDIN WITH (FORMAT text)",
+            _build_copy_buffer((lab_number, invoice_no)
+                               for lab_number, invoices in labno_to_invoices.items()
+                               for invoice_no in invoices)
+        )
+        cursor.execute(sql.SQL("""
+            SELECT p.lab_number, p.time_in, p.request_time_expected, MAX(t.creation_time)
+            FROM patients p
+            JOIN incomplete_invoices i ON i.lab_number = p.lab_number
+            JOIN incomplete_timeouts t ON t.invoice_no = i.invoice_no
+            WHERE {}
+            GROUP BY p.lab_number, p.time_in, p.request_time_expected;
+        """).format(incomplete_condition))
+        matched_records = cursor.fetchall()
+        cursor.execute("DROP TABLE incomplete_timeouts, incomplete_invoices;")
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT update_incomplete")
+        logger.error(f"Failed to match incomplete records with TimeOut data: {e}")
         return
         
     records_to_update = []
-    for lab_number, time_in_str, request_time_expected_str in incomplete_records:
-        latest_timeout_dt = None
-        
-        invoices = labno_to_invoices.get(lab_number, [])
-        for invoice_no in invoices:
-            timeout_info = timeout_data.get(invoice_no)
-            if timeout_info and (not latest_timeout_dt or timeout_info['CreationTime'] > latest_timeout_dt):
-                latest_timeout_dt = timeout_info['CreationTime']
-        
-        if latest_timeout_dt:
-            time_in_dt = parse_datetime_field(str(time_in_str))
-            request_time_expected_dt = parse_datetime_field(str(request_time_expected_str))
-
-            if time_in_dt and request_time_expected_dt:
-                delay_status, time_range = calculate_delay_status_and_range(time_in_dt, latest_timeout_dt, request_time_expected_dt)
-                records_to_update.append({
-                    'lab_number': lab_number,
-                    'request_time_out': latest_timeout_dt,
-                    'request_delay_status': delay_status,
-                    'request_time_range': time_range
-                })
-            else:
-                logger.warning(f"Could not parse datetime for record {lab_number}. Skipping update.")
+    unparsed_records = 0
+    unparsed_samples = []
+    for lab_number, time_in_str, request_time_expected_str, latest_timeout_dt in matched_records:
+        time_in_dt = parse_datetime_field(str(time_in_str))
+        request_time_expected_dt = parse_datetime_field(str(request_time_expected_str))
+
+        if time_in_dt and request_time_expected_dt:
+            delay_status, time_range = calculate_delay_status_and_range(time_in_dt, latest_timeout_dt, request_time_expected_dt)
+            records_to_update.append((lab_number, latest_timeout_dt, delay_status, time_range))
+        else:
+            unparsed_records += 1
+            if len(unparsed_samples) < LOG_SAMPLE_SIZE:
+                unparsed_samples.append(lab_number)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Could not parse datetime for record {lab_number}. Skipping update.")
+
+    if unparsed_records:
+        logger.warning(f"Skipped {unparsed_records} incomplete records with unparseable Time_In or Request_Time_Expected, "
+                       f"e.g. lab numbers {', '.join(unparsed_samples)}.")
                 
     if not records_to_update:
         logger.info("No incomplete records found with available timeout data to update.")
         return
 
+    # One statement for the whole batch: the columns are sent as parallel arrays.
     update_query = """
         UPDATE patients
         SET 
-            request_time_out = %(request_time_out)s,
-            request_delay_status = %(request_delay_status)s,
-            request_time_range = %(request_time_range)s
-        WHERE lab_number = %(lab_number)s;
+            request_time_out = u.request_time_out,
+            request_delay_status = u.request_delay_status,
+            request_time_range = u.request_time_range
+        FROM (
+            SELECT
+                unnest(%s::text[]) AS lab_number,
+                unnest(%s::timestamp[]) AS request_time_out,
+                unnest(%s::text[]) AS request_delay_status,
+                unnest(%s::text[]) AS request_time_range
+        ) AS u
+        WHERE patients.lab_number = u.lab_number;
     """
 
     try:
-        psycopg2.extras.execute_batch(
-            cursor,
-            update_query,
-            records_to_update
-        )
-        conn.commit()
-        logger.info(f"Successfully updated {len(records_to_update)} incomplete records in 'patients' table.")
+        # Transpose the row tuples into one array per unnest() column.
+        cursor.execute(update_query, [list(column) for column in zip(*records_to_update)])
     except Exception as e:
-        conn.rollback()
+        cursor.execute("ROLLBACK TO SAVEPOINT update_incomplete")
         logger.error(f"Failed to update incomplete records: {e}")
+        return
+    conn.commit()
+    logger.info(f"Successfully updated {len(records_to_update)} incomplete records in 'patients' table.")
 
 
 def run_data_ingestion():
@@ -333,53 +584,38 @@ def run_data_ingestion():
         conn = psycopg2.connect(db_url)
         conn.autocommit = False # Use transactions for atomicity
         cursor = conn.cursor()
+        # The load can be replayed from the dataset files, so don't wait on WAL flushes.
+        cursor.execute("SET LOCAL synchronous_commit = off")
         
         ensure_tables_exist(cursor)
         
-        # Load and filter test-level data
-        logger.info("Loading `tests_dataset.json`...")
-        with open(TESTS_DATASET_JSON_PATH, 'r') as f:
-            tests_data = json.load(f)
-        
-        existing_test_ids = get_existing_ids(cursor, 'tests', 'id')
-        new_tests_data = [
-            (
-                rec['ID'], rec['Lab_Number'], rec['Test_Name'], rec['Lab_Section'], rec['TAT'], rec['Price'],
-                parse_datetime_field(rec['Time_Received']), parse_datetime_field(rec['Test_Time_Expected']),
-                rec['Urgency'], parse_datetime_field(rec['Test_Time_Out'])
-            )
-            for rec in tests_data if rec['ID'] not in existing_test_ids
-        ]
-        
-        if new_tests_data:
-            test_columns = ['id', 'lab_number', 'test_name', 'lab_section', 'tat', 'price',
-                            'time_received', 'test_time_expected', 'urgency', 'test_time_out']
-            ingest_data(cursor, 'tests', new_tests_data, 'id', test_columns)
+        # Stream test-level data
+        logger.info("Loading `tests_dataset.jsonl`...")
+        test_fields = ['ID', 'Lab_Number', 'Test_Name', 'Lab_Section', 'TAT', 'Price',
+                       'Time_Received', 'Test_Time_Expected', 'Urgency', 'Test_Time_Out']
+        test_datetime_fields = ['Time_Received', 'Test_Time_Expected', 'Test_Time_Out']
+        test_columns = ['id', 'lab_number', 'test_name', 'lab_section', 'tat', 'price',
+                        'time_received', 'test_time_expected', 'urgency', 'test_time_out']
+        for tests_batch in iter_jsonl_batches(TESTS_DATASET_JSONL_PATH):
+            new_tests_data = build_rows(tests_batch, test_fields, test_datetime_fields)
+            # Test rows are keyed by a generated ID and never change once written.
+            ingest_data(cursor, 'tests', new_tests_data, 'id', test_columns, update_on_conflict=False)
         
-        # Load and filter patient-level data
-        logger.info("Loading `patients_dataset.json`...")
-        with open(PATIENTS_DATASET_JSON_PATH, 'r') as f:
-            patients_data = json.load(f)
-            
-        existing_patient_labnos = get_existing_ids(cursor, 'patients', 'lab_number')
-        new_patients_data = [
-            (
-                rec['Lab_Number'], rec['Client'], rec['Date'], rec['Shift'], rec['Unit'],
-                parse_datetime_field(rec['Time_In']), rec['Daily_TAT'],
-                parse_datetime_field(rec['Request_Time_Expected']),
-                parse_datetime_field(rec['Request_Time_Out']),
-                rec['Request_Delay_Status'],
-                rec['Request_Time_Range']
-            )
-            for rec in patients_data if rec['Lab_Number'] not in existing_patient_labnos
-        ]
-
-        if new_patients_data:
-            patient_columns = ['lab_number', 'client', 'date', 'shift', 'unit',
-                               'time_in', 'daily_tat', 'request_time_expected',
-                               'request_time_out', 'request_delay_status',
-                               'request_time_range']
-            ingest_data(cursor, 'patients', new_patients_data, 'lab_number', patient_columns)
+        # Stream patient-level data
+        logger.info("Loading `patients_dataset.jsonl`...")
+        patient_fields = ['Lab_Number', 'Client', 'Date', 'Shift', 'Unit',
+                          'Time_In', 'Daily_TAT', 'Request_Time_Expected',
+                          'Request_Time_Out', 'Request_Delay_Status',
+                          'Request_Time_Range']
+        patient_datetime_fields = ['Time_In', 'Request_Time_Expected', 'Request_Time_Out']
+        patient_columns = ['lab_number', 'client', 'date', 'shift', 'unit',
+                           'time_in', 'daily_tat', 'request_time_expected',
+                           'request_time_out', 'request_delay_status',
+                           'request_time_range']
+        for patients_batch in iter_jsonl_batches(PATIENTS_DATASET_JSONL_PATH):
+            new_patients_data = build_rows(patients_batch, patient_fields, patient_datetime_fields)
+            # A run's patient rows only cover its new invoices, so existing patients are left as they are.
+            ingest_data(cursor, 'patients', new_patients_data, 'lab_number', patient_columns, update_on_conflict=False)
             
         # Post-ingestion logic
         timeout_data = load_timeout_data()
@@ -387,7 +623,9 @@ def run_data_ingestion():
             
         conn.commit()
         
-        cursor.execute("ANALYZE;")
+        cursor.execute("ANALYZE tests;")
+        cursor.execute("ANALYZE patients;")
+        conn.commit()
         logger.info("Database statistics analyzed.")
         
     except psycopg2.Error as e:
@@ -404,6 +642,7 @@ def run_data_ingestion():
         if conn:
             conn.close()
             logger.info("Database connection closed.")
+        _parse_datetime_cached.cache_clear()
         upload_logs_to_r2()
     
     logger.info("Data ingestion pipeline finished.")
@@ -49,6 +49,11 @@ def main():
         conn = psycopg2.connect(db_url)
         cursor = conn.cursor()
         
+        # The update is one set-based statement; skip the WAL flush wait on commit
+        # and give its grouped join enough memory to avoid spilling to disk.
+        cursor.execute("SET LOCAL synchronous_commit = off")
+        cursor.execute("SET LOCAL work_mem = '64MB'")
+        
         timeout_data = ingest.load_timeout_data()
         ingest.update_incomplete_records(conn, cursor, timeout_data)
         
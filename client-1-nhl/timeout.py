@@ -10,12 +10,18 @@
 
 import os
 import csv
+import re
 import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 import sys
 import logging
+import logging.handlers
 import boto3
+from boto3.s3.transfer import TransferConfig
+import botocore.config
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -38,17 +44,26 @@ SOURCE_FOLDER = Path(os.getenv("SOURCE_FOLDER", "Z:/"))
 OUTPUT_TIMEOUT_CSV_PATH = PUBLIC_DIR / os.getenv("OUTPUT_TIMEOUT_CSV_NAME", "TimeOut.csv")
 LAST_RUN_TIMESTAMP_PATH = PUBLIC_DIR / os.getenv("LAST_RUN_TIMESTAMP_NAME", "last_run.txt")
 DEFAULT_START_TIME = datetime.datetime(2025, 5, 1, 0, 0, 0) # May 1st, 2025, 12:00 AM
+STAT_WORKERS = 16
+# Large uploads are split into 8 MB parts sent in parallel over one client.
+R2_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=8, use_threads=True)
+R2_CLIENT_CONFIG = botocore.config.Config(max_pool_connections=16, retries={'max_attempts': 3, 'mode': 'standard'})
 
 # Ensure logs directory exists
 os.makedirs(LOGS_DIR, exist_ok=True)
 
 # --- Logging Setup ---
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+log_file_handler = logging.FileHandler(os.path.join(LOGS_DIR, 'timeout_debug.log'))
+log_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+# Per-file "Found new file" lines are written in blocks; upload_logs_to_r2() flushes before uploading.
+log_buffer = logging.handlers.MemoryHandler(capacity=4096, flushLevel=logging.ERROR, target=log_file_handler)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
         logging.StreamHandler(sys.stdout),
-        logging.FileHandler(os.path.join(LOGS_DIR, 'timeout_debug.log'))
+        log_buffer
     ]
 )
 logger = logging.getLogger('timeout.py')
@@ -75,19 +90,30 @@ def save_last_run_timestamp(timestamp):
     except Exception as e:
         logger.error(f"Error: Failed to save last run timestamp. Error: {e}")
 
+# Input formats for CreationTime, most common first. The output format leads the
+# slash-separated list since most rows were written by this script.
+SLASH_DATE_FORMATS = (
+    '%m/%d/%Y %I:%M %p',
+    '%m/%d/%Y %H:%M:%S',
+    '%#m/%#d/%Y %I:%M %p',
+    '%#m/%#d/%Y %H:%M',
+)
+DASH_DATE_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+)
+
+# The '%m/%d/%Y %I:%M %p' output of format_creation_time.
+CANONICAL_CREATION_TIME_RE = re.compile(r'(0[1-9]|1[0-2])/(0[1-9]|[12]\d|3[01])/\d{4} (0[1-9]|1[0-2]):[0-5]\d [AP]M')
+
+@functools.lru_cache(maxsize=65536)
 def format_creation_time(time_string):
     """
     Attempts to parse a variety of date formats and return a standardized string.
     Returns None if the string cannot be parsed as a date.
     """
-    date_formats = [
-        '%m/%d/%Y %H:%M:%S',
-        '%m/%d/%Y %I:%M %p',
-        '%#m/%#d/%Y %I:%M %p',
-        '%#m/%#d/%Y %H:%M',
-        '%Y-%m-%d %H:%M:%S',
-        '%Y-%m-%d %H:%M:%S.%f',
-    ]
+    # Only try the formats whose date separator matches the input.
+    date_formats = DASH_DATE_FORMATS if '-' in time_string[:10] else SLASH_DATE_FORMATS
     
     dt_object = None
     for fmt in date_formats:
@@ -101,8 +127,21 @@ def format_creation_time(time_string):
         return dt_object.strftime('%m/%d/%Y %I:%M %p')
     return None
 
+@functools.lru_cache(maxsize=1)
+def get_s3_client(endpoint_url, access_key_id, secret_access_key):
+    """Returns the R2 client, created once per set of credentials."""
+    session = boto3.session.Session()
+    return session.client(
+        's3',
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        config=R2_CLIENT_CONFIG
+    )
+
 def upload_logs_to_r2():
     """Uploads timeout log files to Cloudflare R2 or S3-compatible storage."""
+    log_buffer.flush()
     r2_endpoint_url = os.getenv('R2_ENDPOINT_URL')
     r2_access_key_id = os.getenv('R2_ACCESS_KEY_ID')
     r2_secret_access_key = os.getenv('R2_SECRET_ACCESS_KEY')
@@ -113,26 +152,39 @@ def upload_logs_to_r2():
         logger.error("R2 credentials not fully configured, including R2_CLIENT_FOLDER. Skipping log upload.")
         return
 
-    session = boto3.session.Session()
-    s3_client = session.client(
-        's3',
-        endpoint_url=r2_endpoint_url,
-        aws_access_key_id=r2_access_key_id,
-        aws_secret_access_key=r2_secret_access_key
-    )
-
     log_file_path = os.path.join(LOGS_DIR, 'timeout_debug.log')
     if os.path.exists(log_file_path):
         try:
             # Construct the object key with the client folder prefix
             object_key = f"{r2_client_folder}/{os.path.basename(log_file_path)}"
-            s3_client.upload_file(log_file_path, r2_log_bucket_name, object_key)
+            get_s3_client(r2_endpoint_url, r2_access_key_id, r2_secret_access_key).upload_file(
+                log_file_path, r2_log_bucket_name, object_key, Config=R2_TRANSFER_CONFIG
+            )
             logger.info(f"Successfully uploaded {os.path.basename(log_file_path)} to R2 bucket '{r2_log_bucket_name}' at key '{object_key}'.")
         except Exception as e:
             logger.error(f"Failed to upload {os.path.basename(log_file_path)} to R2: {e}")
     else:
         logger.warning(f"Log file not found, skipping upload: {log_file_path}")
         
+def scan_files(root):
+    """Recursively yields DirEntry objects for the files under root."""
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from scan_files(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+    except OSError as e:
+        logger.warning(f"Could not scan directory '{root}': {e}")
+
+def get_entry_ctime(entry):
+    """Returns (creation_time, None) for a DirEntry, or (None, error) if it cannot be stat'ed."""
+    try:
+        return datetime.datetime.fromtimestamp(entry.stat().st_ctime), None
+    except OSError as e:
+        return None, e
+
 def run_timeout_update():
     """Main function to run the update process."""
     try:
@@ -149,6 +201,7 @@ def run_timeout_update():
         new_records = []
         logger.info(f"\nScanning '{SOURCE_FOLDER}' for new files created after {last_run_time.strftime('%Y-%m-%d %H:%M:%S')}...")
 
+        # FileName -> CreationTime
         merged_data = {}
         # A set for fast lookups of existing filenames
         existing_filenames = set()
@@ -156,17 +209,30 @@ def run_timeout_update():
             logger.info(f"Reading existing data from '{OUTPUT_TIMEOUT_CSV_PATH}'...")
             try:
                 with open(OUTPUT_TIMEOUT_CSV_PATH, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
+                    reader = csv.reader(f)
+                    header = next(reader, [])
+                    file_name_idx = header.index('FileName')
+                    creation_time_idx = header.index('CreationTime')
+                    row_width = max(file_name_idx, creation_time_idx) + 1
                     for row in reader:
+                        if len(row) < row_width:
+                            row.extend([''] * (row_width - len(row)))
+                        file_name = row[file_name_idx]
+                        creation_time = row[creation_time_idx]
+
                         # Add existing filenames to the set for fast lookup
-                        if row.get('FileName'):
-                            existing_filenames.add(row['FileName'])
+                        if file_name:
+                            existing_filenames.add(file_name)
 
-                        formatted_time = format_creation_time(row.get('CreationTime', ''))
+                        # Rows written by this script are already canonical and need no re-parsing.
+                        if CANONICAL_CREATION_TIME_RE.fullmatch(creation_time):
+                            formatted_time = creation_time
+                        else:
+                            formatted_time = format_creation_time(creation_time)
                         if formatted_time:
-                            merged_data[row['FileName']] = {'FileName': row['FileName'], 'CreationTime': formatted_time}
+                            merged_data[file_name] = formatted_time
                         else:
-                            logger.warning(f"Skipping invalid existing creation time for file '{row.get('FileName', 'N/A')}': '{row.get('CreationTime', 'N/A')}'")
+                            logger.warning("Skipping invalid existing creation time for file '%s': '%s'", file_name or 'N/A', creation_time or 'N/A')
                 logger.info(f"Successfully read {len(merged_data)} existing records.")
             except Exception as e:
                 logger.warning(f" Warning: Could not read existing data. Starting with a fresh dataset. Error: {e}")
@@ -175,31 +241,34 @@ def run_timeout_update():
         
         if SOURCE_FOLDER.is_dir():
             logger.info("Starting file system walk to find new files...")
-            for root, dirs, files in os.walk(SOURCE_FOLDER):
-                for file_name in files:
-                    base_name = os.path.splitext(os.path.basename(file_name))[0]
-                    
-                    # Skip files that have already been processed
-                    if base_name in existing_filenames:
+            # Only files not already in TimeOut.csv need their creation time checked.
+            candidates = []
+            is_existing = existing_filenames.__contains__
+            for entry in scan_files(SOURCE_FOLDER):
+                # DirEntry.name is already a bare file name; drop the extension without splitext.
+                file_name = entry.name
+                dot = file_name.rfind('.')
+                base_name = file_name if dot <= 0 else file_name[:dot]
+                if not is_existing(base_name):
+                    candidates.append((entry, base_name))
+            logger.info(f"Checking creation times for {len(candidates)} candidate files...")
+
+            # Stat calls on a network drive are latency bound, so overlap them.
+            with ThreadPoolExecutor(max_workers=STAT_WORKERS) as executor:
+                results = executor.map(lambda candidate: get_entry_ctime(candidate[0]), candidates)
+                for (entry, base_name), (creation_time, error) in zip(candidates, results):
+                    if error:
+                        logger.warning("Could not get creation time for file '%s': %s", entry.path, error)
                         continue
 
-                    file_path = Path(root) / file_name
-                    try:
-                        creation_time_timestamp = os.path.getctime(file_path)
-                        creation_time = datetime.datetime.fromtimestamp(creation_time_timestamp)
-
-                        # Check if the file is new since the last run
-                        if creation_time > last_run_time:
-                            
-                            formatted_time = creation_time.strftime('%m/%d/%Y %I:%M %p')
-                            
-                            new_record = {'FileName': base_name, 'CreationTime': formatted_time}
-                            
-                            new_records.append(new_record)
-                            new_files_found_count += 1
-                            logger.info(f"Found new file: '{file_path}' created at {formatted_time}")
-                    except Exception as e:
-                        logger.warning(f"Could not get creation time for file '{file_path}': {e}")
+                    # Check if the file is new since the last run
+                    if creation_time > last_run_time:
+                        
+                        formatted_time = creation_time.strftime('%m/%d/%Y %I:%M %p')
+                        
+                        new_records.append((base_name, formatted_time))
+                        new_files_found_count += 1
+                        logger.info("Found new file: '%s' created at %s", entry.path, formatted_time)
             logger.info(f"Finished file system walk. Found a total of {new_files_found_count} new files.")
         else:
             logger.error(f"Source folder '{SOURCE_FOLDER}' does not exist or is not a directory.")
@@ -208,19 +277,17 @@ def run_timeout_update():
             logger.info(" No new files found since last scan.")
 
         logger.info(f"Merging {new_files_found_count} new records with existing data...")
-        for record in new_records:
-            merged_data[record['FileName']] = record
+        merged_data.update(new_records)
         
         # ==== 3. EXPORT MERGED DATA TO TimeOut.csv ====
         if merged_data:
             logger.info(f"Exporting {len(merged_data)} consolidated records to '{OUTPUT_TIMEOUT_CSV_PATH}'...")
             try:
                 OUTPUT_TIMEOUT_CSV_PATH.parent.mkdir(parents=True, exist_ok=True)
-                fieldnames = ['FileName', 'CreationTime']
                 with open(OUTPUT_TIMEOUT_CSV_PATH, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(merged_data.values())
+                    writer = csv.writer(f)
+                    writer.writerow(('FileName', 'CreationTime'))
+                    writer.writerows(merged_data.items())
                 logger.info(f"\n Successfully updated '{OUTPUT_TIMEOUT_CSV_PATH}'.\n")
                 
                 save_last_run_timestamp(current_run_time)
@@ -1,14 +1,19 @@
-import json
 import os
 import sys
-import uuid
+import hashlib
+import functools
+import bisect
+import pickle
+import orjson
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import csv
 import logging
 from collections import defaultdict
-import ijson
 from typing import List, Dict, Any, Set
+import numpy as np
+import pandas as pd
+
+from data_store import migrate_legacy_data_file
 
 # --- Environment and Path Configuration ---
 
@@ -32,6 +37,8 @@ DEFAULT_NUMERIC = 0.0
 DEFAULT_DELAY_STATUS = 'Not Uploaded'
 DEFAULT_TIME_RANGE = 'Not Uploaded'
 DEFAULT_URGENCY = 'Not Urgent'
+# data.jsonl is read through a 1 MB buffer to cut read() calls on large files.
+DATA_READ_BUFFER_SIZE = 1 << 20
 CLIENT_IDENTIFIER = os.getenv('CLIENT_IDENTIFIER', 'DefaultClient')
 if CLIENT_IDENTIFIER == 'DefaultClient':
     CLIENT_IDENTIFIER = 'Nakasero'
@@ -39,12 +46,18 @@ if CLIENT_IDENTIFIER == 'DefaultClient':
 # --- File Locations ---
 LOCAL_PUBLIC_DIR = os.path.join(APPLICATION_BASE_DIR, 'public')
 LOGS_DIR = os.path.join(APPLICATION_BASE_DIR, 'debug')
-DATA_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'data.json')
+DATA_JSONL_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'data.jsonl')
+# Pre-JSON Lines store: a single JSON array, converted once by migrate_legacy_data_file()
+LEGACY_DATA_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'data.json')
 META_CSV_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'meta.csv')
 TIMEOUT_CSV_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'TimeOut.csv')
-TESTS_DATASET_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'tests_dataset.json')
-PATIENTS_DATASET_JSON_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'patients_dataset.json')
-PROCESSED_INVOICES_FILE = os.path.join(LOCAL_PUBLIC_DIR, 'processed_invoice_numbers.json')
+TESTS_DATASET_JSONL_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'tests_dataset.jsonl')
+TESTS_DATASET_TMP_PATH = TESTS_DATASET_JSONL_PATH + '.tmp'
+PATIENTS_DATASET_JSONL_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'patients_dataset.jsonl')
+PROCESSED_INVOICES_FILE = os.path.join(LOCAL_PUBLIC_DIR, 'processed_invoice_numbers.pkl')
+# Earlier runs stored the processed invoices as a JSON list; read once if no pickle exists yet.
+LEGACY_PROCESSED_INVOICES_FILE = os.path.join(LOCAL_PUBLIC_DIR, 'processed_invoice_numbers.json')
+LABNO_TO_INVOICES_PATH = os.path.join(LOCAL_PUBLIC_DIR, 'labno_to_invoices.pkl')
 INVALID_LABNOS_OUTPUT_PATH = os.path.join(LOGS_DIR, 'data_json_invalid_labnos.txt')
 UNMATCHED_TEST_NAMES_OUTPUT_PATH = os.path.join(LOGS_DIR, 'data_json_unmatched_test_names.txt')
 
@@ -64,69 +77,64 @@ logging.basicConfig(
 logger = logging.getLogger('transform.py')
 
 # --- Helper Functions ---
-def parse_labno_timestamp(labno):
+def make_test_id(lab_no, invoice_no, test_name):
     """
-    Parses DDMMYYHHMM from a LabNo string.
-    Returns a datetime object or DEFAULT_DATETIME_DT on failure.
+    Returns a deterministic 16-hex-digit ID for a test record. LabNo, InvoiceNo and
+    TestName together identify a record in data.jsonl, so re-running on the same input
+    yields the same IDs.
     """
-    if not isinstance(labno, str) or len(labno) < 10:
-        return DEFAULT_DATETIME_DT
-    
-    timestamp_str = labno[:10]
-    
+    return hashlib.blake2b(f"{lab_no}|{invoice_no}|{test_name}".encode(), digest_size=8).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _parse_labno_prefix(timestamp_str):
+    """Validates and parses a DDMMYYHHMM string, cached since LabNos from the same minute share it."""
     if not timestamp_str.isdigit():
         return DEFAULT_DATETIME_DT
-        
     try:
-        date_str = timestamp_str[4:6] + '-' + timestamp_str[2:4] + '-' + timestamp_str[0:2]
-        time_str = timestamp_str[6:8] + ':' + timestamp_str[8:10]
-        dt_obj = datetime.strptime(f'{date_str} {time_str}', '%y-%m-%d %H:%M')
-        return dt_obj
+        year = int(timestamp_str[4:6])
+        # Two-digit years follow strptime's %y pivot: 00-68 -> 20xx, 69-99 -> 19xx.
+        year += 2000 if year < 69 else 1900
+        return datetime(year, int(timestamp_str[2:4]), int(timestamp_str[0:2]),
+                        int(timestamp_str[6:8]), int(timestamp_str[8:10]))
     except ValueError:
         return DEFAULT_DATETIME_DT
 
-def get_shift(time_in_dt):
-    """Determines shift based on Time_In datetime object."""
-    if not isinstance(time_in_dt, datetime) or time_in_dt.date() == DEFAULT_DATETIME_DT.date():
-        return DEFAULT_STRING
+def parse_labno_timestamp(labno):
+    """
+    Parses DDMMYYHHMM from a LabNo string.
+    Returns a datetime object or DEFAULT_DATETIME_DT on failure.
+    """
+    # Missing or non-string LabNos (None, numbers) fail the slice or the cache lookup.
+    try:
+        timestamp_str = labno[:10]
+        if len(timestamp_str) < 10:
+            return DEFAULT_DATETIME_DT
+        return _parse_labno_prefix(timestamp_str)
+    except TypeError:
+        return DEFAULT_DATETIME_DT
 
-    hour = time_in_dt.hour
-    if 8 <= hour <= 19:
-        return 'Day Shift'
-    else:
-        return 'Night Shift'
+# Upper bounds (minutes) of the Daily_TAT tiers; TATs at or above the last fall in a final tier.
+DAILY_TAT_TIERS = (720, 1440, 4320, 7200, 14400)
 
 def calculate_daily_tat(tats_list):
     """
-    Calculates Daily_TAT based on a tiered logic from a list of individual TATs.
+    Calculates Daily_TAT based on a tiered logic from a list of individual TATs:
+    the longest TAT within the lowest tier that has any TAT.
     Returns 0.0 if no TATs are available.
     """
     if not tats_list:
         return 0.0
     
-    max_tat = max(tats_list)
-    
-    short_tats = [t for t in tats_list if t < 720]
-    if short_tats:
-        return max(short_tats)
-    
-    medium_tats = [t for t in tats_list if t < 1440]
-    if medium_tats:
-        return max(medium_tats)
-        
-    three_day_tats = [t for t in tats_list if t < 4320]
-    if three_day_tats:
-        return max(three_day_tats)
-        
-    five_day_tats = [t for t in tats_list if t < 7200]
-    if five_day_tats:
-        return max(five_day_tats)
-
-    ten_day_tats = [t for t in tats_list if t < 14400]
-    if ten_day_tats:
-        return max(ten_day_tats)
-    
-    return max_tat
+    best_tier = len(DAILY_TAT_TIERS) + 1
+    best_tat = 0.0
+    for tat in tats_list:
+        tier = bisect.bisect_right(DAILY_TAT_TIERS, tat)
+        if tier < best_tier:
+            best_tier = tier
+            best_tat = tat
+        elif tier == best_tier and tat > best_tat:
+            best_tat = tat
+    return best_tat
 
 def calculate_delay_status_and_range(time_in, time_out, expected_time):
     """
@@ -162,23 +170,31 @@ def load_meta_data():
     """Loads meta.csv into a dictionary with error handling."""
     meta_data = {}
     try:
-        with open(META_CSV_PATH, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                test_name = row.get('TestName', DEFAULT_STRING).upper().strip()
-                try:
-                    tat = float(row.get('TAT', DEFAULT_NUMERIC))
-                    price = float(row.get('Price', DEFAULT_NUMERIC))
-                except (ValueError, TypeError):
-                    logger.warning(f"Failed to parse numeric values for TestName '{test_name}'. Using defaults.")
-                    tat = DEFAULT_NUMERIC
-                    price = DEFAULT_NUMERIC
-                
-                meta_data[test_name] = {
-                    'TAT': tat,
-                    'LabSection': row.get('LabSection', DEFAULT_STRING),
-                    'Price': price
-                }
+        # Every column is read as text so empty cells stay empty strings rather than NaN.
+        # The python engine fills the missing cells of short rows with None, as csv.DictReader did.
+        df = pd.read_csv(META_CSV_PATH, dtype=str, keep_default_na=False, encoding='utf-8', engine='python')
+        for column, default in (('TestName', DEFAULT_STRING), ('LabSection', DEFAULT_STRING),
+                                ('TAT', DEFAULT_NUMERIC), ('Price', DEFAULT_NUMERIC)):
+            if column not in df.columns:
+                df[column] = default
+        
+        test_names = df['TestName'].str.upper().str.strip()
+        tats = pd.to_numeric(df['TAT'], errors='coerce')
+        prices = pd.to_numeric(df['Price'], errors='coerce')
+        invalid = tats.isna() | prices.isna()
+        for test_name in test_names[invalid]:
+            logger.warning(f"Failed to parse numeric values for TestName '{test_name}'. Using defaults.")
+        tats[invalid] = DEFAULT_NUMERIC
+        prices[invalid] = DEFAULT_NUMERIC
+        
+        for test_name, tat, lab_section, price in zip(test_names, tats.astype(float).tolist(), df['LabSection'],
+                                                      prices.astype(float).tolist()):
+            meta_data[sys.intern(test_name)] = {
+                'TAT': tat,
+                'TAT_delta': timedelta(minutes=tat),
+                'LabSection': sys.intern(lab_section) if lab_section is not None else None,
+                'Price': price
+            }
         logger.info(f"Successfully loaded {len(meta_data)} test metadata entries.")
     except Exception as e:
         logger.error(f"Failed to load meta.csv: {e}")
@@ -187,59 +203,139 @@ def load_meta_data():
 def load_timeout_data():
     """Loads TimeOut.csv into a dictionary, keeping the latest CreationTime for duplicate FileNames."""
     timeout_data = {}
-    date_formats = ['%m/%d/%Y %I:%M %p', '%#m/%#d/%Y %I:%M %p']
     try:
-        with open(TIMEOUT_CSV_PATH, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                invoice_no = row.get('FileName')
-                creation_time_str = row.get('CreationTime')
-                if not invoice_no or not creation_time_str:
-                    continue
-                
-                creation_time_dt = None
-                for fmt in date_formats:
-                    try:
-                        creation_time_dt = datetime.strptime(creation_time_str, fmt)
-                        break
-                    except ValueError:
-                        continue
-                
-                if creation_time_dt:
-                    if invoice_no not in timeout_data or creation_time_dt > timeout_data[invoice_no]['CreationTime']:
-                        timeout_data[invoice_no] = {'CreationTime': creation_time_dt}
-                    
-                else:
-                    logger.warning(f"Failed to parse CreationTime '{creation_time_str}' for invoice '{invoice_no}'. No matching date format found.")
+        df = pd.read_csv(TIMEOUT_CSV_PATH, dtype=str, keep_default_na=False, encoding='utf-8',
+                         usecols=['FileName', 'CreationTime'])
+        df = df[(df['FileName'] != '') & (df['CreationTime'] != '')]
+        
+        # timeout.py writes every CreationTime as '%m/%d/%Y %I:%M %p'; to_datetime parses
+        # each distinct string once.
+        creation_times = pd.to_datetime(df['CreationTime'], format='%m/%d/%Y %I:%M %p', errors='coerce')
+        unparsed = creation_times.isna()
+        for invoice_no, creation_time_str in zip(df['FileName'][unparsed], df['CreationTime'][unparsed]):
+            logger.warning(f"Failed to parse CreationTime '{creation_time_str}' for invoice '{invoice_no}'. No matching date format found.")
+        
+        latest = creation_times[~unparsed].groupby(df['FileName'][~unparsed], sort=False).max()
+        for invoice_no, creation_time in latest.items():
+            timeout_data[invoice_no] = {'CreationTime': creation_time.to_pydatetime()}
 
     except Exception as e:
         logger.error(f"Failed to load TimeOut.csv: {e}")
     return timeout_data
 
 def load_processed_invoices():
-    """Loads the set of already processed invoices from file."""
-    if not os.path.exists(PROCESSED_INVOICES_FILE):
+    """Loads the set of already processed invoices from file, falling back to the legacy JSON list."""
+    try:
+        with open(PROCESSED_INVOICES_FILE, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except (IOError, pickle.UnpicklingError, EOFError) as e:
+        logger.error(f"Failed to load processed invoices: {e}. Starting with an empty set.")
+        return set()
+
+    if not os.path.exists(LEGACY_PROCESSED_INVOICES_FILE):
         return set()
     try:
-        with open(PROCESSED_INVOICES_FILE, 'r') as f:
-            return set(json.load(f))
-    except (IOError, json.JSONDecodeError) as e:
+        with open(LEGACY_PROCESSED_INVOICES_FILE, 'rb') as f:
+            processed_invoices = set(orjson.loads(f.read()))
+        logger.info(f"Loaded {len(processed_invoices)} processed invoices from {LEGACY_PROCESSED_INVOICES_FILE}.")
+        return processed_invoices
+    except (IOError, orjson.JSONDecodeError) as e:
         logger.error(f"Failed to load processed invoices: {e}. Starting with an empty set.")
         return set()
 
 def save_processed_invoices(processed_invoices):
     """Saves the set of processed invoices to file."""
     try:
-        with open(PROCESSED_INVOICES_FILE, 'w') as f:
-            json.dump(list(processed_invoices), f)
+        with open(PROCESSED_INVOICES_FILE, 'wb') as f:
+            pickle.dump(processed_invoices, f, protocol=pickle.HIGHEST_PROTOCOL)
         logger.info(f"Saved {len(processed_invoices)} processed invoices.")
     except IOError as e:
         logger.error(f"Failed to save processed invoices: {e}")
 
+def save_labno_to_invoices(labno_to_invoices):
+    """Saves the LabNo -> InvoiceNos mapping for ingest.py's post-ingestion updates."""
+    try:
+        with open(LABNO_TO_INVOICES_PATH, 'wb') as f:
+            pickle.dump(labno_to_invoices, f, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info(f"Saved invoice mapping for {len(labno_to_invoices)} LabNos to {LABNO_TO_INVOICES_PATH}")
+    except IOError as e:
+        logger.error(f"Failed to save invoice mapping: {e}")
+
+def write_jsonl(path, records):
+    """Writes records to path as JSON Lines, one record per line."""
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
 # --- Core Transformation Logic ---
+def build_patients_dataset(patients_data_map):
+    """
+    Builds the patient-level records from the aggregated per-LabNo data.
+    Shifts, expected times, delays and their classification are computed
+    column-wise with NumPy; the result matches calculate_delay_status_and_range per patient.
+    """
+    patients = list(patients_data_map.values())
+    if not patients:
+        return []
+    daily_tats = [calculate_daily_tat(data['Tats']) for data in patients]
+
+    time_in = np.array([data['Details']['Time_In_DT'] for data in patients], dtype='datetime64[us]')
+    time_out = np.array([data['Latest_Timeout'] for data in patients], dtype='datetime64[us]')
+    tat_us = np.rint(np.array(daily_tats, dtype=np.float64) * 60_000_000).astype(np.int64)
+    time_expected = time_in + tat_us.astype('timedelta64[us]')
+
+    default_dt = np.datetime64(DEFAULT_DATETIME_DT, 'us')
+    # Day Shift runs 08:00-19:59 by Time_In hour.
+    time_in_hours = (time_in - time_in.astype('datetime64[D]')) // np.timedelta64(1, 'h')
+    shifts = np.select(
+        [time_in == default_dt, (time_in_hours >= 8) & (time_in_hours <= 19)],
+        [DEFAULT_STRING, 'Day Shift'],
+        default='Night Shift'
+    ).tolist()
+
+    not_uploaded = time_out == default_dt
+    delay_minutes = (time_out - time_expected) / np.timedelta64(1, 'm')
+    delay_status = np.select(
+        [not_uploaded, delay_minutes >= 15, delay_minutes > 0, delay_minutes >= -30],
+        [DEFAULT_DELAY_STATUS, 'Over Delayed', 'Delayed for less than 15 minutes', 'On Time'],
+        default='Swift'
+    ).tolist()
+    abs_delay = np.abs(delay_minutes)
+    delay_hours = (abs_delay // 60).astype(np.int64).tolist()
+    delay_mins = (abs_delay % 60).astype(np.int64).tolist()
+    not_uploaded = not_uploaded.tolist()
+
+    expected_strs = np.char.replace(np.datetime_as_string(time_expected, unit='s'), 'T', ' ').tolist()
+    time_out_strs = np.char.replace(np.datetime_as_string(time_out, unit='s'), 'T', ' ').tolist()
+
+    patients_dataset = []
+    for i, (lab_no, data) in enumerate(patients_data_map.items()):
+        details = data['Details']
+        if not_uploaded[i]:
+            time_range = DEFAULT_TIME_RANGE
+        else:
+            time_range = f"{delay_hours[i]} hrs {delay_mins[i]} mins"
+        patients_dataset.append({
+            'Lab_Number': lab_no,
+            'Client': CLIENT_IDENTIFIER,
+            'Date': details.get('Date', DEFAULT_DATE_STR),
+            'Shift': shifts[i],
+            'Unit': details.get('Unit', DEFAULT_STRING),
+            'Time_In': details['Time_In'],
+            'Daily_TAT': daily_tats[i],
+            'Request_Time_Expected': expected_strs[i],
+            'Request_Time_Out': time_out_strs[i],
+            'Request_Delay_Status': delay_status[i],
+            'Request_Time_Range': time_range,
+        })
+    return patients_dataset
+
 def run_data_generation():
     """Orchestrates the entire data generation pipeline."""
     logger.info("Starting data generation pipeline...")
+    migrate_legacy_data_file(DATA_JSONL_PATH, LEGACY_DATA_JSON_PATH)
 
     meta_data = load_meta_data()
     timeout_data = load_timeout_data()
@@ -248,28 +344,44 @@ def run_data_generation():
     newly_processed_invoices = set()
     unmatched_test_names = set()
     invalid_labnos = defaultdict(int)
+    labno_to_invoices = defaultdict(list)
     
-    tests_dataset = []
+    tests_count = 0
+    expected_times = {}
     patients_data_map = defaultdict(lambda: {
         'Tats': [],
-        'InvoiceNos': set(),
+        'Latest_Timeout': DEFAULT_DATETIME_DT,
         'Details': {}
     })
     
     try:
-        with open(DATA_JSON_PATH, 'rb') as f, open(INVALID_LABNOS_OUTPUT_PATH, 'w') as invalid_labnos_log:
-            logger.info("Starting to process raw data from data.json...")
-            parser = ijson.items(f, 'item')
-            for record in parser:
-                invoice_no = record.get('InvoiceNo')
-                lab_no = record.get('LabNo')
-                test_name_raw = record.get('TestName')
+        # Test records are streamed to a temporary file, which replaces tests_dataset.jsonl
+        # only once the whole run succeeds, so ingest.py never sees a partial dataset.
+        with open(DATA_JSONL_PATH, 'rb', buffering=DATA_READ_BUFFER_SIZE) as f, open(INVALID_LABNOS_OUTPUT_PATH, 'w') as invalid_labnos_log, \
+                open(TESTS_DATASET_TMP_PATH, 'wb') as tests_out:
+            logger.info("Starting to process raw data from data.jsonl...")
+            # Bound methods hoisted out of the per-record loop.
+            get_patient_entry = patients_data_map.__getitem__
+            write_test = tests_out.write
+            dumps = orjson.dumps
+            for line in f:
+                if not line.strip():
+                    continue
+                # Only InvoiceNo, LabNo, TestName, EncounterDate and Src are read from each record.
+                record_get = orjson.loads(line).get
+                invoice_no = record_get('InvoiceNo')
+                lab_no = record_get('LabNo')
+                test_name_raw = record_get('TestName')
+
+                # Mapping covers every record, including already processed ones.
+                if lab_no and invoice_no:
+                    labno_to_invoices[lab_no].append(invoice_no)
 
                 if invoice_no in processed_invoices:
                     continue
                     
                 time_in_dt = parse_labno_timestamp(lab_no)
-                if time_in_dt == DEFAULT_DATETIME_DT:
+                if time_in_dt is DEFAULT_DATETIME_DT:
                     invalid_labnos[lab_no] += 1
                     continue
                     
@@ -280,39 +392,52 @@ def run_data_generation():
                     continue
 
                 meta_info = meta_data[normalized_test_name]
-
-                # --- Individual Test-Level Data (`tests_dataset.json`) ---
+                
+                # LabNos from the same minute share time_in_dt, so expected times repeat heavily.
+                expected_key = (time_in_dt, meta_info['TAT'])
+                test_time_expected = expected_times.get(expected_key)
+                if test_time_expected is None:
+                    test_time_expected = (time_in_dt + meta_info['TAT_delta']).strftime('%Y-%m-%d %H:%M:%S')
+                    expected_times[expected_key] = test_time_expected
+
+                # --- Individual Test-Level Data (`tests_dataset.jsonl`) ---
                 individual_test_record = {
-                    'ID': str(uuid.uuid4()),
+                    'ID': make_test_id(lab_no, invoice_no, test_name_raw),
                     'Lab_Number': lab_no,
                     'Test_Name': test_name_raw,
                     'Lab_Section': meta_info['LabSection'],
                     'TAT': meta_info['TAT'],
                     'Price': meta_info['Price'],
                     'Time_Received': DEFAULT_DATETIME_STR,
-                    'Test_Time_Expected': (time_in_dt + timedelta(minutes=meta_info['TAT'])).strftime('%Y-%m-%d %H:%M:%S'),
+                    'Test_Time_Expected': test_time_expected,
                     'Urgency': DEFAULT_URGENCY,
                     'Test_Time_Out': DEFAULT_DATETIME_STR
                 }
-                tests_dataset.append(individual_test_record)
-
-                # --- Aggregate Patient-Level Data (`patients_dataset.json`) ---
-                patients_data_map[lab_no]['Tats'].append(meta_info['TAT'])
-                patients_data_map[lab_no]['InvoiceNos'].add(invoice_no)
+                write_test(dumps(individual_test_record, option=orjson.OPT_APPEND_NEWLINE))
+                tests_count += 1
+
+                # --- Aggregate Patient-Level Data (`patients_dataset.jsonl`) ---
+                patient_entry = get_patient_entry(lab_no)
+                patient_entry['Tats'].append(meta_info['TAT'])
+                # Only the latest TimeOut across the patient's invoices is needed.
+                timeout_info = timeout_data.get(invoice_no)
+                if timeout_info is not None and timeout_info['CreationTime'] > patient_entry['Latest_Timeout']:
+                    patient_entry['Latest_Timeout'] = timeout_info['CreationTime']
                 
-                if not patients_data_map[lab_no]['Details'] or not patients_data_map[lab_no]['Details'].get('LabNo'):
-                    patients_data_map[lab_no]['Details'] = {
+                if not patient_entry['Details'] or not patient_entry['Details'].get('LabNo'):
+                    patient_entry['Details'] = {
                         'LabNo': lab_no,
                         'Client': CLIENT_IDENTIFIER,
-                        'Date': record.get('EncounterDate', DEFAULT_DATE_STR),
+                        # Dates and units repeat across patients; interning keeps one copy of each.
+                        'Date': sys.intern(record_get('EncounterDate') or DEFAULT_DATE_STR),
                         'Time_In': time_in_dt.strftime('%Y-%m-%d %H:%M:%S'),
-                        'Unit': record.get('Src', DEFAULT_STRING)
+                        'Time_In_DT': time_in_dt,
+                        'Unit': sys.intern(record_get('Src') or DEFAULT_STRING)
                     }
                 
                 newly_processed_invoices.add(invoice_no)
 
-            for labno, count in invalid_labnos.items():
-                invalid_labnos_log.write(f"LabNo: {labno}, Occurrences: {count}\n")
+            invalid_labnos_log.write(''.join(f"LabNo: {labno}, Occurrences: {count}\n" for labno, count in invalid_labnos.items()))
             logger.info(f"Logged invalid LabNos to {INVALID_LABNOS_OUTPUT_PATH}")
 
     except Exception as e:
@@ -320,58 +445,23 @@ def run_data_generation():
         return
 
     # --- Finalize patient-level data after processing all records ---
-    patients_dataset = []
-    for lab_no, data in patients_data_map.items():
-        time_in_dt = parse_labno_timestamp(lab_no)
-        daily_tat = calculate_daily_tat(data['Tats'])
-        
-        request_time_out_dt = DEFAULT_DATETIME_DT
-        latest_timeout = DEFAULT_DATETIME_DT
-        
-        for invoice_no in data['InvoiceNos']:
-            if invoice_no in timeout_data:
-                current_timeout = timeout_data[invoice_no]['CreationTime']
-                if current_timeout > latest_timeout:
-                    latest_timeout = current_timeout
-
-        request_time_out_dt = latest_timeout
-        
-        request_time_expected_dt = time_in_dt + timedelta(minutes=daily_tat)
-        
-        delay_status, time_range = calculate_delay_status_and_range(time_in_dt, request_time_out_dt, request_time_expected_dt)
-
-        patient_record = {
-            'Lab_Number': lab_no,
-            'Client': CLIENT_IDENTIFIER,
-            'Date': data['Details'].get('Date', DEFAULT_DATE_STR),
-            'Shift': get_shift(time_in_dt),
-            'Unit': data['Details'].get('Unit', DEFAULT_STRING),
-            'Time_In': time_in_dt.strftime('%Y-%m-%d %H:%M:%S'),
-            'Daily_TAT': daily_tat,
-            'Request_Time_Expected': request_time_expected_dt.strftime('%Y-%m-%d %H:%M:%S'),
-            'Request_Time_Out': request_time_out_dt.strftime('%Y-%m-%d %H:%M:%S'),
-            'Request_Delay_Status': delay_status,
-            'Request_Time_Range': time_range,
-        }
-        patients_dataset.append(patient_record)
+    patients_dataset = build_patients_dataset(patients_data_map)
 
     # --- Save Outputs ---
     try:
-        with open(TESTS_DATASET_JSON_PATH, 'w') as f:
-            json.dump(tests_dataset, f, indent=4)
-        logger.info(f"Successfully generated {len(tests_dataset)} test records and saved to {TESTS_DATASET_JSON_PATH}")
+        os.replace(TESTS_DATASET_TMP_PATH, TESTS_DATASET_JSONL_PATH)
+        logger.info(f"Successfully generated {tests_count} test records and saved to {TESTS_DATASET_JSONL_PATH}")
 
-        with open(PATIENTS_DATASET_JSON_PATH, 'w') as f:
-            json.dump(patients_dataset, f, indent=4)
-        logger.info(f"Successfully generated {len(patients_dataset)} patient records and saved to {PATIENTS_DATASET_JSON_PATH}")
+        write_jsonl(PATIENTS_DATASET_JSONL_PATH, patients_dataset)
+        logger.info(f"Successfully generated {len(patients_dataset)} patient records and saved to {PATIENTS_DATASET_JSONL_PATH}")
         
         with open(UNMATCHED_TEST_NAMES_OUTPUT_PATH, 'w') as f:
-            for name in unmatched_test_names:
-                f.write(f"{name}\n")
+            f.write(''.join(f"{name}\n" for name in unmatched_test_names))
         logger.info(f"Logged {len(unmatched_test_names)} unmatched test names to {UNMATCHED_TEST_NAMES_OUTPUT_PATH}")
 
         processed_invoices.update(newly_processed_invoices)
         save_processed_invoices(processed_invoices)
+        save_labno_to_invoices(dict(labno_to_invoices))
         
     except Exception as e:
         logger.error(f"Failed to save output files: {e}")
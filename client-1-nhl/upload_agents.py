@@ -1,6 +1,10 @@
 import os
 import sys
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
+import botocore.config
 from dotenv import load_dotenv
 
 def get_application_base_dir():
@@ -24,22 +28,32 @@ AGENT_EXECUTABLES = [
     'Zyntel_Slow_Agent_Nakasero.exe'
 ]
 
+# Agent executables are large; upload them as parallel multipart transfers.
+R2_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4, use_threads=True)
+R2_CLIENT_CONFIG = botocore.config.Config(max_pool_connections=16, retries={'max_attempts': 3, 'mode': 'standard'})
+
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    session = boto3.session.Session()
+    return session.client('s3',
+                          endpoint_url=R2_ENDPOINT_URL,
+                          aws_access_key_id=R2_ACCESS_KEY_ID,
+                          aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                          config=R2_CLIENT_CONFIG)
+
 def upload_agent_to_r2(file_path, bucket_name, client_folder):
     if not all([R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, bucket_name, client_folder]):
         print("R2 credentials or client folder name are incomplete. Skipping upload.")
         return
 
     try:
-        s3 = boto3.client('s3',
-                          endpoint_url=R2_ENDPOINT_URL,
-                          aws_access_key_id=R2_ACCESS_KEY_ID,
-                          aws_secret_access_key=R2_SECRET_ACCESS_KEY)
+        s3 = get_s3_client()
 
         # Construct the key with the client folder prefix
         object_key = f"{client_folder}/{os.path.basename(file_path)}"
         
         print(f"Uploading {file_path} to R2 bucket '{bucket_name}' under key '{object_key}'...")
-        s3.upload_file(str(file_path), bucket_name, object_key)
+        s3.upload_file(str(file_path), bucket_name, object_key, Config=R2_TRANSFER_CONFIG)
         print(f"Successfully uploaded {file_path} to R2.")
     except Exception as e:
         print(f"Failed to upload {file_path} to R2: {e}")
@@ -51,12 +65,13 @@ def main():
         print("Error: 'dist' folder not found. Please compile the agents first.")
         return
 
-    for agent_name in AGENT_EXECUTABLES:
-        agent_path = os.path.join(dist_folder, agent_name)
-        if os.path.exists(agent_path):
-            upload_agent_to_r2(agent_path, R2_BUCKET_NAME, R2_CLIENT_FOLDER)
-        else:
-            print(f"Warning: {agent_name} not found in the 'dist' folder.")
+    with ThreadPoolExecutor(max_workers=len(AGENT_EXECUTABLES)) as executor:
+        for agent_name in AGENT_EXECUTABLES:
+            agent_path = os.path.join(dist_folder, agent_name)
+            if os.path.exists(agent_path):
+                executor.submit(upload_agent_to_r2, agent_path, R2_BUCKET_NAME, R2_CLIENT_FOLDER)
+            else:
+                print(f"Warning: {agent_name} not found in the 'dist' folder.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file